@@ -0,0 +1,5 @@
+"""
+Benchmarks for the bot's hot paths, run against seeded synthetic data with
+fake database and interaction objects, so neither Discord nor Postgres is
+needed. Run with `python -m benchmarks --help`.
+"""
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import sys
+from typing import Any, Callable
+
+from plugins.utils import poo_cache_utils
+from plugins.utils.charts import create_clock_plot
+from plugins.utils.poo_objects import Pooper, from_epoch_us
+from plugins.utils.poo_rollup import fetch_day_events
+from plugins.poo_master import PooMaster, page_cache
+from plugins.statistician import Statistician
+
+from .checks import check_snapshot_warm_up
+from .fakes import FakeContext, FakeDatabase, unwrap_command
+from .generator import FIRST_USER_ID, generate_records
+from .harness import compare, load, measure, save
+
+def build_cases(records: list[dict[str, Any]]) -> dict[str, Callable[[], Any]]:
+    """Loads the fake data into the cache and sets up every benchmark"""
+    poo_cache_utils.db = FakeDatabase(records) # type: ignore
+    poo_cache_utils.LAZY_LOADING = False
+    asyncio.run(poo_cache_utils.load_data())
+
+    # Looked up on every call, since benchmarking load_data replaces it
+    user_id = FIRST_USER_ID
+    def pooper() -> Pooper:
+        return poo_cache_utils.poo_cache[user_id]
+
+    middle = pooper().event_times[len(pooper()) // 2]
+    day = from_epoch_us(middle).date()
+
+    statistician: Any = object.__new__(Statistician)
+    poo_master: Any = object.__new__(PooMaster)
+    list_statistics = unwrap_command(Statistician.list_statistics)
+    list_events = unwrap_command(PooMaster.list_events)
+    log_scrolled = unwrap_command(PooMaster.log_scrolled)
+    scroll_id = (
+        f"LOG PAGE|{user_id}|{day.year}|{day.month}|{day.day}|0|{middle}|+1"
+    )
+
+    # Rendered pages are dropped first, so every call does the work
+    def uncached(func: Callable[[], Any]) -> Callable[[], Any]:
+        def call() -> Any:
+            page_cache.clear()
+            return func()
+        return call
+
+    return {
+        "cache.load_data": poo_cache_utils.load_data,
+        "pagination.get_day_events": lambda: pooper().get_day_events(
+            day, after=middle
+        ),
+        "pagination.fetch_day_events": lambda: fetch_day_events(
+            user_id, day, poo_cache_utils.db.connection, after=middle
+        ),
+        "stats.range_totals": lambda: pooper().range_totals(
+            day - dt.timedelta(days=365), day
+        ),
+        "stats.list_statistics": lambda: list_statistics(
+            statistician, FakeContext(user_id)
+        ),
+        "charts.create_clock_plot": lambda: create_clock_plot(
+            pooper().minutes_of_day()
+        ),
+        "log.list_events": uncached(lambda: list_events(
+            poo_master, FakeContext(user_id), day.year, day.month, day.day
+        )),
+        "log.log_scrolled": uncached(lambda: log_scrolled(
+            poo_master, FakeContext(user_id, scroll_id)
+        )),
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks the cache, pagination, stats and charts."
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--events", type=int, default=1_000,
+                        help="events per user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--only", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="a JSON file of baseline results")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed slowdown before failing, as a fraction")
+    args = parser.parse_args()
+
+    # The numbers mean nothing if the cache loads the wrong events
+    failures = check_snapshot_warm_up()
+    for failure in failures:
+        print(f"CHECK FAILED snapshot warm-up, {failure}")
+    if failures:
+        return 1
+
+    records = generate_records(args.users, args.events, args.seed)
+    cases = build_cases(records)
+
+    results: dict[str, dict[str, float]] = {}
+    print(
+        f"{args.users} users x {args.events} events (seed {args.seed})\n" +
+        f"{'benchmark':<34}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}" +
+        f"{'p99 ms':>10}{'peak KiB':>11}"
+    )
+    for name, func in cases.items():
+        if args.only not in name:
+            continue
+        result = results[name] = measure(func, repeat=args.repeat)
+        print(
+            f"{name:<34}{result['ops_per_sec']:>10.1f}" +
+            f"{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}" +
+            f"{result['p99_ms']:>10.3f}{result['peak_kib']:>11.1f}"
+        )
+
+    config = {"users": args.users, "events": args.events, "seed": args.seed}
+    if args.save:
+        save(args.save, {"config": config, "results": results})
+
+    if args.compare:
+        baseline = load(args.compare)
+        if baseline["config"] != config:
+            print(f"Baseline was run with {baseline['config']}, not {config}")
+            return 2
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
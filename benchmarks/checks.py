@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import os
+import tempfile
+from collections import Counter
+from typing import Any
+
+from plugins.utils import poo_cache_utils
+
+from .fakes import FakeDatabase
+from .generator import FIRST_USER_ID, generate_records
+
+async def _restart_from_snapshot() -> None:
+    """Warms up from the snapshot and waits for the users it resyncs"""
+    poo_cache_utils.warmup_complete = False
+    await poo_cache_utils.load_data(from_snapshot=True)
+    await asyncio.sleep(0)
+    await asyncio.gather(*poo_cache_utils._pending_loads.values())
+
+def check_snapshot_warm_up() -> list[str]:
+    """
+    Takes a snapshot, then adds rows older than its high-water mark for a
+    user it doesn't have and restarts from it, as happens when a backdated
+    import lands while the snapshot is being written.
+
+    Returns
+    -------
+    failures : list[str]
+        Each user whose cached events don't match the database
+    """
+    records = generate_records(3, 50)
+    original_db = poo_cache_utils.db
+    original_path = poo_cache_utils.SNAPSHOT_PATH
+    poo_cache_utils.db = FakeDatabase(records) # type: ignore
+    poo_cache_utils.SNAPSHOT_PATH = tempfile.mktemp(suffix=".snapshot")
+    try:
+        poo_cache_utils.clear_cache()
+        asyncio.run(poo_cache_utils.load_data())
+        asyncio.run(poo_cache_utils.save_snapshot())
+
+        backdated: dict[str, Any] = dict(
+            records[0],
+            user_id=FIRST_USER_ID + 3,
+            event_time=records[0]["event_time"] - dt.timedelta(days=1),
+        )
+        records.append(backdated)
+        asyncio.run(_restart_from_snapshot())
+
+        expected = Counter(r["user_id"] for r in records)
+        return [
+            f"{user_id}: {expected[user_id]} events in the database, " +
+            f"{len(poo_cache_utils.poo_cache.get(user_id, ()))} cached"
+            for user_id in expected
+            if len(poo_cache_utils.poo_cache.get(user_id, ())) != expected[user_id]
+        ]
+    finally:
+        if os.path.exists(poo_cache_utils.SNAPSHOT_PATH):
+            os.remove(poo_cache_utils.SNAPSHOT_PATH)
+        poo_cache_utils.SNAPSHOT_PATH = original_path
+        poo_cache_utils.db = original_db
+        poo_cache_utils.clear_cache()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import contextlib
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, AsyncIterator
+
+from plugins.utils.poo_objects import DEFAULT_TIMEZONE
+
+class FakeCursor:
+    """Pages through a list of records like an asyncpg cursor"""
+
+    def __init__(self, records: list[dict[str, Any]]) -> None:
+        self.records = records
+        self.position = 0
+
+    async def fetch(self, count: int) -> list[dict[str, Any]]:
+        chunk = self.records[self.position:self.position + count]
+        self.position += count
+        return chunk
+
+class FakeConnection:
+    """
+    Answers the bot's queries from a list of records. Queries filtered on
+    user_id get that user's records, everything else gets all of them.
+    Paged queries (user_id, start, end, limit) get that slice of them, and
+    the warm-up cursor gets the records after its high-water mark. Every
+    user is in the default timezone, and each user's change counter is the
+    number of records they have.
+    """
+
+    def __init__(self, records: list[dict[str, Any]]) -> None:
+        self.records = records
+
+    def _matching(self, args: tuple) -> list[dict[str, Any]]:
+        if args and isinstance(args[0], int):
+            return [r for r in self.records if r["user_id"] == args[0]]
+        return self.records
+
+    def _versions(self) -> Counter[int]:
+        return Counter(r["user_id"] for r in self.records)
+
+    async def cursor(self, query: str, *args: Any) -> FakeCursor:
+        if isinstance(args[0], int):
+            return FakeCursor(self._matching(args))
+        return FakeCursor([r for r in self.records if r["event_time"] > args[0]])
+
+    async def fetch(self, query: str, *args: Any) -> list[dict[str, Any]]:
+        if "poo_users" in query:
+            return []
+        if "poo_event_versions" in query:
+            return [
+                {"user_id": user_id, "version": version}
+                for user_id, version in self._versions().items()
+            ]
+        if "LIMIT" in query:
+            _, start, end, limit = args
+            rows = [
+                r for r in self._matching(args)
+                if start <= r["event_time"] < end
+            ]
+            if "DESC" in query:
+                rows.reverse()
+            return rows[:limit]
+        return self._matching(args)
+
+    async def fetchrow(self, query: str, *args: Any) -> dict[str, Any]:
+        # Only the day count query of fetch_day_events
+        day = args[1]
+        return {
+            "timezone": DEFAULT_TIMEZONE.key,
+            "day_count": sum(
+                r["event_time"].astimezone(DEFAULT_TIMEZONE).date() == day
+                for r in self._matching(args)
+            ),
+        }
+
+    async def fetchval(self, query: str, *args: Any) -> Any:
+        if "poo_event_versions" in query:
+            return self._versions()[args[0]] or None
+        return None
+
+    async def execute(self, query: str, *args: Any) -> str:
+        return "INSERT 0 1"
+
+    async def executemany(self, query: str, args: list[tuple]) -> None:
+        pass
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, **kwargs: Any) -> AsyncIterator[None]:
+        yield
+
+class FakeDatabase:
+    """Stands in for `novus.ext.database` with a single fake connection"""
+
+    def __init__(self, records: list[dict[str, Any]]) -> None:
+        self.connection = FakeConnection(records)
+        self.Database = self
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[FakeConnection]:
+        yield self.connection
+
+class FakeContext:
+    """An interaction that records what the bot sends instead of sending it"""
+
+    def __init__(self, user_id: int, custom_id: str = "") -> None:
+        self.user = SimpleNamespace(id=user_id, username="benchmark")
+        self.data = SimpleNamespace(custom_id=custom_id)
+        self.message = SimpleNamespace()
+        self.sent: list[dict[str, Any]] = []
+
+    async def send(self, content: str | None = None, **kwargs: Any) -> None:
+        self.sent.append({"content": content, **kwargs})
+
+    async def update(self, **kwargs: Any) -> None:
+        self.sent.append(kwargs)
+
+    async def defer(self, **kwargs: Any) -> None:
+        pass
+
+def unwrap_command(command: Any) -> Any:
+    """Gets the plain coroutine function back out of a command decorator"""
+    for attribute in ("func", "callback", "command", "__wrapped__"):
+        inner = getattr(command, attribute, None)
+        if callable(inner):
+            return unwrap_command(inner)
+    return command
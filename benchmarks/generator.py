@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import random
+from typing import Any
+
+import datetime as dt
+
+from plugins.utils.poo_objects import Volume, Texture, Shape, Feel, Color, \
+                                    Smell, DEFAULT_TIMEZONE
+
+# The first user ID handed out, so IDs look like Discord snowflakes
+FIRST_USER_ID = 100_000_000_000_000_000
+
+def generate_records(
+            users: int,
+            events_per_user: int,
+            seed: int = 0,
+            days: int = 365
+        ) -> list[dict[str, Any]]:
+    """
+    Generates poo_events rows for `users` users with `events_per_user`
+    events each, spread over the `days` days before 2024-01-01. The same
+    seed always gives the same rows.
+
+    Returns
+    -------
+    records : list[dict[str, Any]]
+        Rows ordered by (user_id, event_time), like the warm-up query
+    """
+    rng = random.Random(seed)
+    start = dt.datetime(2024, 1, 1, tzinfo=DEFAULT_TIMEZONE) - dt.timedelta(days=days)
+    span = days * 24 * 60 * 60 * 1_000_000
+
+    records = []
+    for user in range(users):
+        offsets = sorted(set(
+            rng.randrange(span) for _ in range(events_per_user)
+        ))
+        for offset in offsets:
+            records.append({
+                "user_id": FIRST_USER_ID + user,
+                "volume": rng.choice(list(Volume)),
+                "texture": rng.choice(list(Texture)),
+                "shape": rng.choice(list(Shape)),
+                "feel": rng.choice(list(Feel)),
+                "wipe_count": rng.randint(0, 12),
+                "color": rng.choice(list(Color)),
+                "smell": rng.choice(list(Smell)),
+                "continuous": rng.random() < 0.8,
+                "rise": rng.random() < 0.3,
+                "event_time": start + dt.timedelta(microseconds=offset),
+            })
+    return records
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import json
+import statistics
+import time
+import tracemalloc
+from typing import Any, Callable
+
+def measure(
+            func: Callable[[], Any],
+            repeat: int = 50,
+            warmup: int = 3,
+            min_time: float = 0.5
+        ) -> dict[str, float]:
+    """
+    Times a function over at least `repeat` calls, and keeps calling it
+    until `min_time` seconds have been spent, so fast operations get enough
+    samples for stable percentiles. Anything it returns that can be awaited
+    is run to completion.
+
+    Returns
+    -------
+    result : dict[str, float]
+        Calls per second, p50/p95/p99 latency in milliseconds, and the peak
+        memory allocated during a single call in KiB
+    """
+    loop = asyncio.new_event_loop()
+
+    def call() -> Any:
+        result = func()
+        if inspect.isawaitable(result):
+            return loop.run_until_complete(result)
+        return result
+
+    try:
+        for _ in range(warmup):
+            call()
+
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timings: list[float] = []
+        while len(timings) < repeat or sum(timings) < min_time:
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+    finally:
+        loop.close()
+
+    timings.sort()
+    def percentile(fraction: float) -> float:
+        return timings[min(len(timings) - 1, int(fraction * len(timings)))] * 1000
+
+    return {
+        "ops_per_sec": len(timings) / sum(timings),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "peak_kib": peak / 1024,
+    }
+
+# Changes smaller than these are noise, however large they are relatively
+NOISE_FLOORS: dict[str, float] = {
+    "p50_ms": 0.05,
+    "peak_kib": 16.0,
+}
+
+def compare(
+            results: dict[str, dict[str, float]],
+            baseline: dict[str, dict[str, float]],
+            threshold: float = 0.2
+        ) -> list[str]:
+    """
+    Lists the benchmarks whose p50 latency or peak memory grew by more than
+    `threshold` (a fraction) compared to a saved baseline, and by more than
+    the metric's `NOISE_FLOORS` entry
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, noise_floor in NOISE_FLOORS.items():
+            before, after = baseline[name][metric], result[metric]
+            if (
+                        before and after > before * (1 + threshold)
+                        and after - before > noise_floor
+                    ):
+                regressions.append(
+                    f"{name}: {metric} {before:.3f} -> {after:.3f} " +
+                    f"(+{(after / before - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+def save(path: str, results: dict[str, Any]) -> None:
+    with open(path, "w") as file:
+        json.dump(results, file, indent=4, sort_keys=True)
+
+def load(path: str) -> dict[str, Any]:
+    with open(path) as file:
+        return json.load(file)
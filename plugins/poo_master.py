@@ -5,31 +5,69 @@ from novus import types as t
 from novus.ext import client, database as db
 
 import datetime as dt
-from zoneinfo import ZoneInfo as tz
 import random
 
 from .utils.poo_objects import Volume, Texture, Shape, Feel, \
-                                    Color, Smell, LoggedEvent
-from .utils.poo_cache_utils import get_pooper, poo_modify_cache_db
+                                    Color, Smell, LoggedEvent, to_epoch_us
+from .utils.poo_cache_utils import fetch_pooper, poo_modify_cache_db, \
+                                    event_listeners, \
+                                    get_timezone, resolve_timezone, \
+                                    set_user_timezone, is_cached
+from .utils.poo_rollup import fetch_day_events, fetch_local_today
+from .utils.lru import LRUCache
+from .utils import metrics, poo_cache_utils
+from .utils.metrics import timed, COMMAND_LATENCY, COMPONENT_LATENCY
 from .utils.autocomplete import VOLUME_OPTIONS, TEXTURE_OPTIONS, \
                                 SHAPE_OPTIONS, FEEL_OPTIONS, \
                                     COLOR_OPTIONS, SMELL_OPTIONS, BOOLEAN_OPTIONS
 
 log = logging.getLogger("plugins.poo_master")
 
+# How many events are shown on each /log list page
+PAGE_SIZE: int = 6
+# How many rendered /log list pages are kept for scrolling back and forth
+PAGE_CACHE_SIZE: int = 512
+
+# (embed, page count, buttons) of cached users' pages, keyed by
+# (user_id, date, page, after, before, day version)
+page_cache: LRUCache[
+    tuple[int, dt.date, int, int | None, int | None, int],
+    tuple[n.Embed, int, list[n.ActionRow]]
+] = LRUCache(max_items=PAGE_CACHE_SIZE)
+
+def forget_day_pages(user_id: int, event: LoggedEvent) -> None:
+    """Drops the cached pages of the day an event was added to"""
+    date = event.event_time.astimezone(get_timezone(user_id)).date()
+    page_cache.discard_where(lambda key: key[:2] == (user_id, date))
+
 class PooMaster(client.Plugin):
 
+    async def on_load(self) -> None:
+        """Starts invalidating cached pages when events are added"""
+        event_listeners.append(forget_day_pages)
+
+    async def on_unload(self) -> None:
+        if forget_day_pages in event_listeners:
+            event_listeners.remove(forget_day_pages)
+        page_cache.clear()
+
     @client.event.filtered_component(
-        r"LOG SCROLL\|\d+\|\d+\|\d+\|\d+\|\d+\|(\+|-)\d+"
+        r"LOG PAGE\|\d+\|\d+\|\d+\|\d+\|\d+\|-?\d+\|(\+|-)1"
     )
+    @timed(COMPONENT_LATENCY, "log scroll")
     async def log_scrolled(self, ctx: t.ComponentI):
-        """Pinged when a scroll button is clicked"""
+        """
+        Pinged when a scroll button is clicked. The button carries the time
+        of the event on the edge of the current page, so the next page is
+        found from there instead of by counting pages from the day's start.
+        """
 
-        _, user_id, year, month, day, current_page, direction = ctx.data.custom_id.split("|")
+        _, user_id, year, month, day, current_page, boundary, direction = ctx.data.custom_id.split("|")
 
         user_id = int(user_id)
-        year, month, day = int(year), int(month), int(day)
+        date = dt.date(int(year), int(month), int(day))
         current_page = int(current_page)
+        boundary = int(boundary)
         direction = int(direction)
 
         if user_id != ctx.user.id:
@@ -38,24 +76,47 @@ class PooMaster(client.Plugin):
         if not ctx.message:
             return
 
-        pooper = get_pooper(ctx.user.id)
-
-        paginated_events: dict[dt.datetime, list[list[LoggedEvent]]]
-        paginated_events = pooper.get_paginated_events()
+        if direction > 0:
+            after, before = boundary, None
+        else:
+            after, before = None, boundary
 
-        new_formatted_page, final_page = self.get_formatted_page(
-            paginated_events, year, month, day, current_page + direction
+        new_formatted_page, _, buttons = await self.get_rendered_page(
+            user_id, date, current_page + direction, after, before
         )
 
-        await ctx.update(
-            embeds=[new_formatted_page],
-            components=self.get_scroll_buttons(
-                ctx.user.id, year, month, day,
-                current_page + direction, final_page
-            )
+        await ctx.update(embeds=[new_formatted_page], components=buttons)
+
+    @client.event.filtered_component(
+        r"LOG SCROLL\|\d+\|\d+\|\d+\|\d+\|\d+\|(\+|-)\d+"
+    )
+    @timed(COMPONENT_LATENCY, "log scroll")
+    async def old_log_scrolled(self, ctx: t.ComponentI):
+        """
+        Pinged when a scroll button from before pages were found by event
+        time is clicked. Those only know the page number, so they go back to
+        the first page of the day.
+        """
+
+        _, user_id, year, month, day, _, _ = ctx.data.custom_id.split("|")
+
+        user_id = int(user_id)
+        date = dt.date(int(year), int(month), int(day))
+
+        if user_id != ctx.user.id:
+            return
+
+        if not ctx.message:
+            return
+
+        new_formatted_page, _, buttons = await self.get_rendered_page(
+            user_id, date
         )
 
+        await ctx.update(embeds=[new_formatted_page], components=buttons)
+
     @client.event.filtered_component(r"LOG CANCEL\|\d+")
+    @timed(COMPONENT_LATENCY, "log cancel")
     async def log_cancelled(self, ctx: t.ComponentI):
         """Pinged when a user cancels log viewing"""
 
@@ -144,6 +205,7 @@ class PooMaster(client.Plugin):
             ),
         ]
     )
+    @timed(COMMAND_LATENCY, "log add")
     async def add_event(
                 self,
                 ctx: t.CommandI,
@@ -192,13 +254,13 @@ class PooMaster(client.Plugin):
             smell,
             continuous,
             rise,
-            event_time:=dt.datetime.now(tz("America/Los_Angeles"))
+            event_time:=dt.datetime.now(dt.timezone.utc)
         )
 
         log.info(f"Attempting to log '{repr(logged_event)}' to {ctx.user.id}")
 
         # Update the cache and database
-        async with db.Database.acquire() as conn:
+        if poo_cache_utils.WRITE_BEHIND:
             success = await poo_modify_cache_db(
                 ctx.user.id,
                 volume,
@@ -211,8 +273,24 @@ class PooMaster(client.Plugin):
                 continuous,
                 rise,
                 event_time,
-                conn
+                defer=True
             )
+        else:
+            async with metrics.acquire(db) as conn:
+                success = await poo_modify_cache_db(
+                    ctx.user.id,
+                    volume,
+                    texture,
+                    shape,
+                    feel,
+                    wipe_count,
+                    color,
+                    smell,
+                    continuous,
+                    rise,
+                    event_time,
+                    conn
+                )
 
         if not success:
             return await ctx.send(
@@ -248,6 +326,7 @@ class PooMaster(client.Plugin):
             ),
         ]
     )
+    @timed(COMMAND_LATENCY, "log list")
     async def list_events(
                 self,
                 ctx: t.CommandI,
@@ -257,60 +336,139 @@ class PooMaster(client.Plugin):
             ) -> None:
         """List's a your events in a paginated format"""
 
-        now = dt.datetime.now(tz("America/Los_Angeles"))
+        # Users that aren't cached are paged through from the database,
+        # without loading their whole history
+        if is_cached(ctx.user.id):
+            pooper = await fetch_pooper(ctx.user.id)
+            if not len(pooper):
+                return await ctx.send("You have no logged events to display.")
+            today = dt.datetime.now(pooper.timezone).date()
+        else:
+            async with metrics.acquire(db) as conn:
+                today = await fetch_local_today(ctx.user.id, conn)
 
-        year = year or now.year
-        month = month or now.month
-        day = day or now.day
+        year = year or today.year
+        month = month or today.month
+        day = day or today.day
 
         try:
-            dt.datetime(year, month, day)
+            date = dt.date(year, month, day)
         except:
             return await ctx.send("Please enter a valid date.")
 
-        pooper = get_pooper(ctx.user.id)
+        formatted_page, page_count, buttons = await self.get_rendered_page(
+            ctx.user.id, date
+        )
 
-        paginated_events: dict[dt.datetime, list[list[LoggedEvent]]]
-        paginated_events = pooper.get_paginated_events()
+        if not page_count:
+            return await ctx.send(
+                "You have no logged events on that day to display."
+            )
 
-        if not paginated_events:
-            return await ctx.send("You have no logged events to display.")
+        await ctx.send(embeds=[formatted_page], components=buttons)
 
-        formatted_page, final_page = self.get_formatted_page(
-            paginated_events, year, month, day, 0
-        )
+    @client.command(
+        name="log timezone",
+        options = [
+            n.ApplicationCommandOption(
+                name="timezone",
+                type=n.ApplicationOptionType.string,
+                description="Your timezone, e.g. Europe/London or America/New_York",
+                required=True
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "log timezone")
+    async def set_timezone(
+                self,
+                ctx: t.CommandI,
+                timezone: str
+            ) -> None:
+        """Sets the timezone your events are grouped into days by"""
 
-        if final_page < 0:
+        try:
+            user_timezone = resolve_timezone(timezone.strip())
+        except ValueError:
             return await ctx.send(
-                "You have no logged events on that day to display."
+                f"I don't know the timezone `{timezone}`.", ephemeral=True
             )
 
+        # Load the user first so their events are redone in the new timezone
+        await fetch_pooper(ctx.user.id)
+        async with metrics.acquire(db) as conn:
+            await set_user_timezone(ctx.user.id, user_timezone, conn)
+
         await ctx.send(
-            embeds=[formatted_page],
-            components=self.get_scroll_buttons(
-                ctx.user.id, year, month, day, 0, final_page
+            f"Your events will now be shown in {user_timezone.key} time.",
+            ephemeral=True
+        )
+
+    async def get_rendered_page(
+                self,
+                user_id: int,
+                date: dt.date,
+                page: int = 0,
+                after: int | None = None,
+                before: int | None = None
+            ) -> tuple[n.Embed, int, list[n.ActionRow]]:
+        """
+        Gets the embed, page count and scroll buttons for the page of a day
+        after or before an event time (see `Pooper.get_day_events`).
+
+        Cached users' pages are reused from `page_cache` while the day hasn't
+        changed. Everyone else's are read from the database a page at a time.
+        """
+        if is_cached(user_id):
+            pooper = await fetch_pooper(user_id)
+            cache_key = (
+                user_id, date, page, after, before,
+                pooper.day_versions.get(date, 0)
             )
+            rendered = page_cache.get(cache_key)
+            if rendered is not None:
+                return rendered
+            page_events, day_count = pooper.get_day_events(
+                date, after, before, PAGE_SIZE
+            )
+        else:
+            cache_key = None
+            async with metrics.acquire(db) as conn:
+                page_events, day_count = await fetch_day_events(
+                    user_id, date, conn, after, before, PAGE_SIZE
+                )
+
+        if (
+                    not page_events and day_count
+                    and (after is not None or before is not None)
+                ):
+            # The events around the boundary were removed, start over
+            return await self.get_rendered_page(user_id, date)
+
+        page_count = -(-day_count // PAGE_SIZE)
+        page = max(0, min(page, page_count - 1))
+        embed = self.get_formatted_page(date, page_events, page, page_count)
+        buttons = self.get_scroll_buttons(
+            user_id, date, page_events, page, page_count - 1
         )
+        rendered = (embed, page_count, buttons)
+        if cache_key is not None:
+            page_cache.put(cache_key, rendered)
+
+        return rendered
 
     def get_formatted_page(
                 self,
-                paginated_events: dict[dt.datetime, list[list[LoggedEvent]]],
-                year: int, month: int, day: int,
-                page: int = 0
-            ) -> tuple[n.Embed, int]:
+                date: dt.date,
+                page_events: list[LoggedEvent],
+                page: int = 0,
+                page_count: int = 1
+            ) -> n.Embed:
         """"""
-        fake_date = dt.datetime(
-            year=year, month=month, day=day, tzinfo=tz("America/Los_Angeles")
-        )
-
-        embed = n.Embed(title=fake_date.strftime("%B %d, %Y"))
+        embed = n.Embed(title=date.strftime("%B %d, %Y"))
 
-        if not fake_date in paginated_events or page < 0:
-            return embed, -1
+        if not page_events:
+            return embed
 
-        day_pages = paginated_events[fake_date]
-        page = min(len(day_pages) - 1, page)
-        page_events = day_pages[page]
         for event in page_events:
             embed.add_field(
                 name=event.event_time.strftime("%I:%M:%S %p") + "-------------",
@@ -318,29 +476,35 @@ class PooMaster(client.Plugin):
                 inline=False
             )
 
-        embed.set_footer(f"{page + 1}/{len(day_pages)}")
+        embed.set_footer(f"{page + 1}/{page_count}")
 
-        return embed, len(day_pages) - 1
+        return embed
 
     def get_scroll_buttons(
                 self,
                 user_id: int,
-                year: int,
-                month: int,
-                day: int,
+                date: dt.date,
+                page_events: list[LoggedEvent],
                 current_page: int = 0,
                 final_page: int = 1,
             ) -> list[n.ActionRow]:
         """"""
 
+        # Each button carries the time of the event on its edge of the page
+        page_id = f"LOG PAGE|{user_id}|{date.year}|{date.month}|{date.day}|" + \
+                    f"{current_page}"
+        first_time = last_time = 0
+        if page_events:
+            first_time = to_epoch_us(page_events[0].event_time)
+            last_time = to_epoch_us(page_events[-1].event_time)
+
         buttons = []
         # Add left button
         buttons.append(
             n.Button(
                 label="Left",
-                custom_id=f"LOG SCROLL|{user_id}|{year}|{month}|{day}|" + \
-                            f"{current_page}|-1",
-                disabled=(current_page == 0)
+                custom_id=f"{page_id}|{first_time}|-1",
+                disabled=(current_page <= 0)
             )
         )
 
@@ -357,9 +521,8 @@ class PooMaster(client.Plugin):
         buttons.append(
             n.Button(
                 label="Right",
-                custom_id=f"LOG SCROLL|{user_id}|{year}|{month}|{day}|" + \
-                            f"{current_page}|+1",
-                disabled=(current_page == final_page)
+                custom_id=f"{page_id}|{last_time}|+1",
+                disabled=(current_page >= final_page)
             )
         )
 
@@ -1,78 +1,103 @@
+import asyncio
 import io
 import logging
+from concurrent.futures.process import BrokenProcessPool
+
 import novus as n
 from novus import types as t
-from novus.ext import client
+from novus.ext import client, database as db
 
 import datetime as dt
-from zoneinfo import ZoneInfo as tz
-from matplotlib import pyplot as plt
-from matplotlib.projections.polar import PolarAxes
-from matplotlib.colors import Normalize, LinearSegmentedColormap
-import numpy as np
-import requests
 
-from .utils.poo_objects import LoggedEvent
-from .utils.poo_cache_utils import get_pooper
+from .utils.poo_cache_utils import fetch_pooper, event_listeners, is_cached
+from .utils.poo_rollup import PooStats, fetch_rollup_stats, \
+                                fetch_minute_counts, fetch_rollup_range, \
+                                fetch_local_today
+from .utils import metrics
+from .utils.metrics import timed, COMMAND_LATENCY
+from .utils.mc_status import StatusUnavailable, mc_status
+from .utils.charts import RendererBusy, renderer, chart_cache, \
+                            forget_user_charts
 
 log = logging.getLogger("plugins.poo_master")
 
+def period_bounds(
+            period: str,
+            today: dt.date
+        ) -> tuple[dt.date, dt.date, dt.date]:
+    """
+    Finds the calendar week (from Monday), month or year containing a day,
+    and the one before it
+
+    Returns
+    -------
+    this_start : dt.date
+        The first day of the period containing `today`
+    last_start : dt.date
+        The first day of the period before
+    last_end : dt.date
+        The last day of the period before
+    """
+    if period == "week":
+        this_start = today - dt.timedelta(days=today.weekday())
+        last_start = this_start - dt.timedelta(days=7)
+    elif period == "month":
+        this_start = today.replace(day=1)
+        last_start = (this_start - dt.timedelta(days=1)).replace(day=1)
+    elif period == "year":
+        this_start = today.replace(month=1, day=1)
+        last_start = this_start.replace(year=this_start.year - 1)
+    else:
+        raise ValueError(f"Unknown period {period!r}")
+
+    return this_start, last_start, this_start - dt.timedelta(days=1)
+
 
 class Statistician(client.Plugin):
 
+    async def on_load(self) -> None:
+        """Starts invalidating cached charts when events are added"""
+        event_listeners.append(forget_user_charts)
+
+    async def on_unload(self) -> None:
+        """Stops the chart workers and HTTP session and drops cached charts"""
+        if forget_user_charts in event_listeners:
+            event_listeners.remove(forget_user_charts)
+        chart_cache.clear()
+        renderer.close()
+        await mc_status.close()
+
     @client.command(name="stats table")
+    @timed(COMMAND_LATENCY, "stats table")
     async def list_statistics(self, ctx: t.CommandI):
         """Calculates some helpful event statistics"""
         stats_embed = n.Embed(title=f"{ctx.user.username}'s Poopy Statistics")
         stats_embed.color = 0x563D2D
 
-        pooper = get_pooper(ctx.user.id)
-        paginated_events: dict[dt.datetime, list[list[LoggedEvent]]]
-        paginated_events = pooper.get_paginated_events()
-
-        now = dt.datetime.now(tz("America/Los_Angeles"))
-        year = now.year
-        month = now.month
-        day = now.day
-
-        lifetime_p = 0
-        year_p = 0
-        month_p = 0
-        day_p = 0
-
-        years_a: set[int] = set()
-        months_a: set[int] = set()
-        days_a: set[int] = set()
-
-        total_wipes: int = 0
-        max_wipe: int = 0
-
-        for time_part, all_poops_matrix in paginated_events.items():
-            years_a.add(time_part.year)
-            months_a.add(time_part.month)
-            days_a.add(time_part.day)
-
-            for all_poops in all_poops_matrix:
-                for poop in all_poops:
-                    lifetime_p += 1
-
-                    if poop.event_time.year == year:
-                        year_p += 1
-                    if poop.event_time.month == month:
-                        month_p += 1
-                    if poop.event_time.day == day:
-                        day_p += 1
-
-                    total_wipes += poop.wipe_count
-                    if poop.wipe_count > max_wipe:
-                        max_wipe = poop.wipe_count
-
-        if not (years_a and months_a and days_a):
+        # Users who aren't cached are answered from the daily rollup
+        # instead of loading their whole history
+        if is_cached(ctx.user.id):
+            pooper = await fetch_pooper(ctx.user.id)
+            today = dt.datetime.now(pooper.timezone).date()
+            stats = PooStats.from_pooper(pooper, today)
+        else:
+            async with metrics.acquire(db) as conn:
+                stats = await fetch_rollup_stats(ctx.user.id, conn)
+
+        if not stats.lifetime:
             return await ctx.send(\
                 "Something went wrong gathering statistics. " + \
                 "You may not have any logs."
             )
 
+        lifetime_p = stats.lifetime
+        year_p = stats.year
+        month_p = stats.month
+        day_p = stats.day
+
+        total_wipes = stats.total_wipes
+        max_wipe = stats.max_wipe
+
         stats_embed.add_field(
             name="Lifetime Poops",
             value=str(lifetime_p),
@@ -97,17 +122,17 @@ class Statistician(client.Plugin):
 
         stats_embed.add_field(
             name="Avg. Poops/Day",
-            value=str(lifetime_p//len(days_a)),
+            value=str(lifetime_p//stats.days),
             inline=True
         )
         stats_embed.add_field(
             name="Avg. Poops/Month",
-            value=str(lifetime_p//len(months_a)),
+            value=str(lifetime_p//stats.months),
             inline=True
         )
         stats_embed.add_field(
             name="Avg. Poops/Year",
-            value=str(lifetime_p//len(years_a)),
+            value=str(lifetime_p//stats.years),
             inline=True
         )
 
@@ -129,148 +154,261 @@ class Statistician(client.Plugin):
 
         await ctx.send(embeds=[stats_embed])
 
-    @client.command(name="stats graph frequency")
-    async def graph_frequency(self, ctx:t.CommandI):
+    @client.command(
+        name="stats graph frequency",
+        options = [
+            n.ApplicationCommandOption(
+                name="theme",
+                type=n.ApplicationOptionType.string,
+                description="The colours to draw the graph in (default **Dark**)",
+                choices=[
+                    n.ApplicationCommandChoice(name="Dark", value="dark"),
+                    n.ApplicationCommandChoice(name="Light", value="light"),
+                ],
+                required=False
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "stats graph frequency")
+    async def graph_frequency(self, ctx:t.CommandI, theme: str = "dark"):
         """Visualizes the commonality of delivery times"""
         stats_embed = n.Embed(title=f"{ctx.user.username}'s Poo-Time Frequency")
         stats_embed.color = 0x563D2D
 
-        pooper = get_pooper(ctx.user.id)
-        logged_events = pooper.logged_events
-
-        await ctx.defer()
-
-        image = Statistician.create_clock_plot(logged_events)
-        image.seek(0)
-        file = n.File(image, "graph.png")
+        # Users who aren't cached are drawn from the minute rollup, with one
+        # weighted entry per minute
+        weights = None
+        if is_cached(ctx.user.id):
+            pooper = await fetch_pooper(ctx.user.id)
+            version = pooper.version
+            minutes = pooper.minutes_of_day()
+        else:
+            async with metrics.acquire(db) as conn:
+                version, minutes, weights = await fetch_minute_counts(
+                    ctx.user.id, conn
+                )
+            version = -version
+
+        # Nothing new has been logged since this was last drawn
+        minute_intervals = 30
+        cache_key = (ctx.user.id, version, minute_intervals, theme)
+        image = chart_cache.get(cache_key)
+
+        if image is None:
+            await ctx.defer()
+
+            try:
+                image = await renderer.render_clock_plot(
+                    minutes, minute_intervals, theme, weights
+                )
+            except RendererBusy:
+                return await ctx.send(
+                    "Too many graphs are being drawn right now, try again soon."
+                )
+            except asyncio.TimeoutError:
+                log.warning(f"Clock plot for {ctx.user.id} timed out")
+                return await ctx.send(
+                    "That graph took too long to draw, try again later."
+                )
+            except BrokenProcessPool:
+                return await ctx.send(
+                    "Something went wrong drawing that graph, try again."
+                )
+
+            chart_cache.put(cache_key, image)
+
+        file = n.File(io.BytesIO(image), "graph.png")
         stats_embed.set_image(url="attachment://graph.png")
         await ctx.send(embeds=[stats_embed], files=[file])
 
-    @staticmethod
-    def create_clock_plot(
-                logged_events: list[LoggedEvent],
-                minute_intervals: int = 30
-            ) -> io.BytesIO:
-        """Creates a clock-plot of event-time frequency"""
-
-        # Fill the axis with time-parts based on the minute interval
-        start_time = dt.datetime(
-            year=1, month=1, day=1,
-            tzinfo=tz("America/Los_Angeles")
-        )
-        end_time = dt.datetime(
-            year=1, month=1, day=1,
-            hour=23, minute=60-minute_intervals,
-            tzinfo=tz("America/Los_Angeles")
-        )
-        axis_times = [start_time]
-        while axis_times[-1] < end_time:
-            axis_times.append(
-                axis_times[-1] + dt.timedelta(minutes=minute_intervals)
+    @client.command(
+        name="stats range",
+        options = [
+            n.ApplicationCommandOption(
+                name="days",
+                type=n.ApplicationOptionType.integer,
+                description="How many days up to the end day to count (default 7)",
+                required=False,
+                min_value=1,
+                max_value=36_500
+            ),
+            n.ApplicationCommandOption(
+                name="start",
+                type=n.ApplicationOptionType.string,
+                description="The first day to count, as YYYY-MM-DD",
+                required=False
+            ),
+            n.ApplicationCommandOption(
+                name="end",
+                type=n.ApplicationOptionType.string,
+                description="The last day to count, as YYYY-MM-DD (default today)",
+                required=False
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "stats range")
+    async def range_statistics(
+                self,
+                ctx: t.CommandI,
+                days: int = 0,
+                start: str = "",
+                end: str = ""
+            ) -> None:
+        """Counts your events over a range of days"""
+        try:
+            end_date = (
+                dt.date.fromisoformat(end.strip()) if end
+                else await self.get_local_today(ctx.user.id)
+            )
+            start_date = (
+                dt.date.fromisoformat(start.strip()) if start
+                else end_date - dt.timedelta(days=max(days or 7, 1) - 1)
             )
-        axis_times.append(dt.datetime(
-            year=1, month=1, day=2,
-            hour=0, minute=0,
-            tzinfo=tz("America/Los_Angeles")
-        ))
-
-        # Create the plot itself
-        plt.figure(figsize=(8,8))
-        clock_plot: PolarAxes = plt.subplot(111, projection="polar") # type: ignore
-
-        # Make the clock start at midnight and go clockwise around
-        clock_plot.set_theta_direction(-1)
-        clock_plot.set_theta_zero_location("N")
-
-        # The hidden radian ticks
-        theta = np.linspace(0, 2 * np.pi, len(axis_times) - 1, endpoint=False)
-
-        # The input data (maps onto the hidden ticks)
-        event_by_time = sorted(
-            logged_events,
-            key=lambda e: Statistician.truncate_datetime(e.event_time)
+        except (ValueError, OverflowError):
+            return await ctx.send("Please enter dates as YYYY-MM-DD.")
+
+        if start_date > end_date:
+            return await ctx.send("The start day has to be before the end day.")
+
+        event_count, wipe_count = await self.get_range_totals(
+            ctx.user.id, start_date, end_date
         )
+        day_count = (end_date - start_date).days + 1
 
-        next_axis_time = 1
-        current_event = 0
-        counts = [0]
-        # Calculate the frequency of each time-piece
-        while current_event < len(event_by_time):
-            event = event_by_time[current_event]
-            if Statistician.truncate_datetime(event.event_time) < axis_times[next_axis_time]:
-                counts[-1] += 1
-            else:
-                next_axis_time += 1
-                current_event -= 1
-                counts.append(0)
-
-            current_event += 1
-        while len(counts) < len(axis_times) - 1:
-            counts.append(0)
-
-        # Plot the bars onto the clock
-        clock_plot.bar(
-            theta,
-            np.ones_like(counts),
-            width=2*np.pi/len(counts),
-            align='edge',
-            color=Statistician.frequency_to_color(counts)
+        stats_embed = n.Embed(
+            title=f"{ctx.user.username}'s Poopy Statistics, " +
+                f"{start_date:%b %d, %Y} - {end_date:%b %d, %Y}"
         )
+        stats_embed.color = 0x563D2D
 
-        # Format the clock nicer
-        clock_plot.set_yticks([0, 1])
-        clock_plot.set_rmax(1)
-        clock_plot.set_xticks(
-            ticks=theta,
-            labels=[
-                s.strftime("%I:%M %p")
-                if not s.minute else ''
-                for s in axis_times[:-1]
-            ]
+        stats_embed.add_field(
+            name="Poops",
+            value=str(event_count),
+            inline=True
+        )
+        stats_embed.add_field(
+            name="Avg. Poops/Day",
+            value=f"{event_count / day_count:.2f}",
+            inline=True
         )
-        clock_plot.tick_params(pad=15, grid_color='#F6F6F6', labelcolor="white")
-        plt.setp(clock_plot.get_yticklabels(), visible=False)
-        plt.ylim(0, 1)
-
-        image_data = io.BytesIO()
-        plt.savefig(image_data, format="png", transparent=True)
-        plt.close()
-
-        return image_data
-
-    @staticmethod
-    def truncate_datetime(to_truncate: dt.datetime):
-        return dt.datetime(
-            1, 1, 1,
-            to_truncate.hour,
-            to_truncate.minute,
-            to_truncate.second,
-            tzinfo=tz("America/Los_Angeles")
+        stats_embed.add_field(
+            name="Wipes Made",
+            value=str(wipe_count),
+            inline=True
         )
 
-    @staticmethod
-    def frequency_to_color(counts: list[int]):
-        normalizer = Normalize(vmin=min(counts), vmax=max(counts))
+        await ctx.send(embeds=[stats_embed])
+
+    @client.command(
+        name="stats compare",
+        options = [
+            n.ApplicationCommandOption(
+                name="period",
+                type=n.ApplicationOptionType.string,
+                description="The period to compare with the one before (default **Week**)",
+                choices=[
+                    n.ApplicationCommandChoice(name="Week", value="week"),
+                    n.ApplicationCommandChoice(name="Month", value="month"),
+                    n.ApplicationCommandChoice(name="Year", value="year"),
+                ],
+                required=False
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "stats compare")
+    async def compare_statistics(
+                self,
+                ctx: t.CommandI,
+                period: str = "week"
+            ) -> None:
+        """Compares this week, month or year with the last one"""
+        today = await self.get_local_today(ctx.user.id)
+        this_start, last_start, last_end = period_bounds(period, today)
+
+        # The last period up to the same point as this one
+        last_to_date = min(last_start + (today - this_start), last_end)
+
+        this_events, this_wipes = await self.get_range_totals(
+            ctx.user.id, this_start, today
+        )
+        last_events, last_wipes = await self.get_range_totals(
+            ctx.user.id, last_start, last_end
+        )
+        so_far_events, so_far_wipes = await self.get_range_totals(
+            ctx.user.id, last_start, last_to_date
+        )
 
-        starting_color = (1, 1, 1) # White
-        ending_color = (0.361, 0.251, 0.2) # Brown
+        stats_embed = n.Embed(
+            title=f"{ctx.user.username}'s Poopy Statistics, " +
+                f"This {period.title()} vs Last {period.title()}"
+        )
+        stats_embed.color = 0x563D2D
 
-        cmap = LinearSegmentedColormap.from_list(
-            "poop", [starting_color, ending_color]
+        stats_embed.add_field(
+            name=f"This {period.title()}",
+            value=f"{this_events} poops, {this_wipes} wipes",
+            inline=True
+        )
+        stats_embed.add_field(
+            name=f"Last {period.title()} So Far",
+            value=f"{so_far_events} poops, {so_far_wipes} wipes",
+            inline=True
+        )
+        stats_embed.add_field(
+            name=f"Last {period.title()}",
+            value=f"{last_events} poops, {last_wipes} wipes",
+            inline=True
+        )
+        stats_embed.add_field(
+            name="Change So Far",
+            value=f"{this_events - so_far_events:+} poops, " +
+                f"{this_wipes - so_far_wipes:+} wipes",
+            inline=False
         )
-        return cmap(normalizer(counts))
+
+        await ctx.send(embeds=[stats_embed])
+
+    async def get_local_today(self, user_id: int) -> dt.date:
+        """The current date in a user's timezone"""
+        if is_cached(user_id):
+            pooper = await fetch_pooper(user_id)
+            return dt.datetime.now(pooper.timezone).date()
+
+        async with metrics.acquire(db) as conn:
+            return await fetch_local_today(user_id, conn)
+
+    async def get_range_totals(
+                self,
+                user_id: int,
+                start: dt.date,
+                end: dt.date
+            ) -> tuple[int, int]:
+        """
+        Adds up a user's events and wipes between two local days, from the
+        cache's prefix sums or, for uncached users, the daily rollup
+        """
+        if is_cached(user_id):
+            pooper = await fetch_pooper(user_id)
+            return pooper.range_totals(start, end)
+
+        async with metrics.acquire(db) as conn:
+            return await fetch_rollup_range(user_id, start, end, conn)
 
     @client.command(name="mc")
+    @timed(COMMAND_LATENCY, "mc")
     async def server(self, ctx: t.CommandI):
         """
         Finds info on the Minecraft server and sends an embed to chat
         """
 
-        API_ENDPOINT = "https://api.mcstatus.io/v2/status/java/"
         SERVER_ADDRESS = "ThundaDownUnda.aternos.me"
 
-        request = requests.get(API_ENDPOINT + SERVER_ADDRESS)
-        server_data = request.json()
+        try:
+            server_data = await mc_status.get_status(SERVER_ADDRESS)
+        except StatusUnavailable:
+            return await ctx.send(
+                "Couldn't reach the server status API, try again later."
+            )
 
         embed = n.Embed(title="Minecraft Server!")
 
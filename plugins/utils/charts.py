@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Sequence
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.projections.polar import PolarAxes
+from matplotlib.colors import Normalize, LinearSegmentedColormap
+import numpy as np
+
+from .lru import LRUCache
+
+log = logging.getLogger("plugins.utils.charts")
+
+# The number of processes drawing charts at once
+RENDER_WORKERS: int = 2
+# How many charts may wait for a free worker before new ones are refused
+RENDER_QUEUE_DEPTH: int = 8
+# How long a single chart may take before the request gives up (seconds)
+RENDER_TIMEOUT: float = 30.0
+# The most rendered image bytes kept around for repeat requests
+CHART_CACHE_BYTES: int = 32 * 1024 * 1024
+
+THEMES: dict[str, dict[str, Any]] = {
+    "dark": {
+        "colors": [(1, 1, 1), (0.361, 0.251, 0.2)], # White to brown
+        "label_color": "white",
+        "grid_color": "#F6F6F6",
+    },
+    "light": {
+        "colors": [(1, 1, 1), (0.361, 0.251, 0.2)], # White to brown
+        "label_color": "black",
+        "grid_color": "#303030",
+    },
+}
+
+# Every minute of the day, for the histogram bins
+MINUTES_PER_DAY: int = 24 * 60
+
+# zlib level for chart PNGs. 1 is several times faster to encode than the
+# default of 6, for slightly larger files
+PNG_COMPRESS_LEVEL: int = 1
+
+# Built once, instead of on every render
+COLORMAPS: dict[str, LinearSegmentedColormap] = {
+    name: LinearSegmentedColormap.from_list("poop", style["colors"])
+    for name, style in THEMES.items()
+}
+
+def minute_histogram(
+            minutes: Sequence[int] | np.ndarray,
+            minute_intervals: int = 30,
+            weights: Sequence[int] | np.ndarray | None = None
+        ) -> np.ndarray:
+    """
+    Bins minute-of-day values into equal slices of the day
+
+    Parameters
+    ----------
+    minutes: Sequence[int] | np.ndarray
+        The local minute of the day (0-1439) of each event
+    minute_intervals: int
+        The width of each bin, which must divide the 1440 minutes of a day
+    weights: Sequence[int] | np.ndarray | None
+        An optional weight per event (e.g. its wipe count or volume) to sum
+        instead of counting events
+
+    Returns
+    -------
+    histogram : np.ndarray
+        One total per bin, starting at midnight
+    """
+    if minute_intervals <= 0 or MINUTES_PER_DAY % minute_intervals:
+        raise ValueError(
+            f"minute_intervals must divide {MINUTES_PER_DAY}, " +
+            f"got {minute_intervals}"
+        )
+
+    bins = np.asarray(minutes, dtype=np.int64) // minute_intervals
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    return np.bincount(
+        bins,
+        weights=weights,
+        minlength=MINUTES_PER_DAY // minute_intervals
+    )
+
+class ClockTemplate:
+    """
+    A clock plot figure with its axes, ticks, labels and bars already laid
+    out, so each render only recolours the bars and draws.
+
+    Built on the object-oriented `Figure` API rather than pyplot, so it
+    holds no global state. A template must still only be used by one thread
+    at a time, see `get_clock_template`.
+
+    Parameters
+    ----------
+    minute_intervals: int
+        The number of minutes covered by each slice of the clock
+    theme: str
+        The name of the colours to use from `THEMES`
+    """
+
+    def __init__(self, minute_intervals: int = 30, theme: str = "dark") -> None:
+        style = THEMES[theme]
+        self.theme = theme
+        self.slice_count = MINUTES_PER_DAY // minute_intervals
+        bin_starts = range(0, MINUTES_PER_DAY, minute_intervals)
+
+        # Transparent throughout, like savefig(transparent=True)
+        self.figure = Figure(figsize=(8,8))
+        self.figure.patch.set_alpha(0)
+        self.canvas = FigureCanvasAgg(self.figure)
+        clock_plot: PolarAxes = self.figure.add_subplot(
+            111, projection="polar"
+        ) # type: ignore
+        clock_plot.patch.set_alpha(0)
+
+        # Make the clock start at midnight and go clockwise around
+        clock_plot.set_theta_direction(-1)
+        clock_plot.set_theta_zero_location("N")
+
+        # The hidden radian ticks
+        theta = np.linspace(0, 2 * np.pi, self.slice_count, endpoint=False)
+
+        # One full-height bar per slice, recoloured by `render`
+        self.bars = clock_plot.bar(
+            theta,
+            np.ones(self.slice_count),
+            width=2*np.pi/self.slice_count,
+            align='edge'
+        )
+
+        # Format the clock nicer
+        clock_plot.set_yticks([0, 1])
+        clock_plot.set_rmax(1)
+        clock_plot.set_xticks(
+            ticks=theta,
+            labels=[
+                f"{(start // 60) % 12 or 12:02}:00 {'AM' if start < 720 else 'PM'}"
+                if not start % 60 else ''
+                for start in bin_starts
+            ]
+        )
+        clock_plot.tick_params(
+            pad=15,
+            grid_color=style["grid_color"],
+            labelcolor=style["label_color"]
+        )
+        for label in clock_plot.get_yticklabels():
+            label.set_visible(False)
+        clock_plot.set_ylim(0, 1)
+
+    def render(self, counts: np.ndarray) -> bytes:
+        """Colours each slice by its count and encodes the figure as a PNG"""
+        if len(counts) != self.slice_count:
+            raise ValueError(
+                f"Expected {self.slice_count} counts, got {len(counts)}"
+            )
+
+        for bar, color in zip(self.bars, frequency_to_color(counts, self.theme)):
+            bar.set_facecolor(color)
+
+        image_data = io.BytesIO()
+        self.canvas.print_png(
+            image_data,
+            metadata={"Software": None},
+            pil_kwargs={"compress_level": PNG_COMPRESS_LEVEL}
+        )
+        return image_data.getvalue()
+
+# Each thread of each worker process builds its own templates, keyed by
+# (minute_intervals, theme)
+_templates = threading.local()
+
+def get_clock_template(minute_intervals: int, theme: str) -> ClockTemplate:
+    """Gets this thread's `ClockTemplate`, building it on first use"""
+    templates: dict[tuple[int, str], ClockTemplate] | None = getattr(
+        _templates, "clocks", None
+    )
+    if templates is None:
+        templates = _templates.clocks = {}
+
+    key = (minute_intervals, theme)
+    template = templates.get(key)
+    if template is None:
+        template = templates[key] = ClockTemplate(minute_intervals, theme)
+    return template
+
+def create_clock_plot(
+            minutes: Sequence[int],
+            minute_intervals: int = 30,
+            theme: str = "dark",
+            weights: Sequence[int] | None = None
+        ) -> bytes:
+    """
+    Creates a clock-plot of event-time frequency
+
+    Parameters
+    ----------
+    minutes: Sequence[int]
+        The local minute of the day (0-1439) of each event
+    minute_intervals: int
+        The number of minutes covered by each slice of the clock
+    theme: str
+        The name of the colours to use from `THEMES`
+    weights: Sequence[int] | None
+        An optional weight per event, see `minute_histogram`
+
+    Returns
+    -------
+    image_data : bytes
+        The plot, encoded as a PNG
+    """
+    # The input data (maps onto the hidden ticks)
+    counts = minute_histogram(minutes, minute_intervals, weights)
+    return get_clock_template(minute_intervals, theme).render(counts)
+
+def frequency_to_color(counts: np.ndarray, theme: str = "dark"):
+    normalizer = Normalize(vmin=counts.min(), vmax=counts.max())
+    return COLORMAPS[theme](normalizer(counts))
+
+class RendererBusy(Exception):
+    """Raised when too many charts are already waiting to be drawn"""
+
+class ChartRenderer:
+    """
+    Draws charts in a bounded pool of worker processes so that matplotlib
+    never blocks the event loop.
+
+    Parameters
+    ----------
+    max_workers: int
+        The number of worker processes
+    max_queued: int
+        How many jobs may wait for a worker before `RendererBusy` is raised
+    timeout: float
+        How long to wait for a single job, in seconds
+    """
+
+    def __init__(
+                self,
+                max_workers: int = RENDER_WORKERS,
+                max_queued: int = RENDER_QUEUE_DEPTH,
+                timeout: float = RENDER_TIMEOUT
+            ) -> None:
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+
+        self._executor: ProcessPoolExecutor | None = None
+        self._in_flight: int = 0
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """The worker pool, started on first use"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def render_clock_plot(
+                self,
+                minutes: Sequence[int],
+                minute_intervals: int = 30,
+                theme: str = "dark",
+                weights: Sequence[int] | None = None
+            ) -> bytes:
+        """
+        Draws `create_clock_plot` in a worker process
+
+        Raises
+        ------
+        RendererBusy
+            Too many charts are already being drawn or waiting
+        asyncio.TimeoutError
+            The chart took longer than `timeout` to draw
+        BrokenProcessPool
+            A worker died, so the pool is dropped and the next chart starts
+            a new one
+        """
+        if self._in_flight >= self.max_workers + self.max_queued:
+            raise RendererBusy("Too many charts are queued")
+
+        executor = self.executor
+        try:
+            future = executor.submit(
+                create_clock_plot, minutes, minute_intervals, theme, weights
+            )
+        except BrokenProcessPool:
+            self._drop_broken(executor)
+            raise
+        # A job that times out keeps its worker until it actually finishes,
+        # so it only stops counting then
+        self._in_flight += 1
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: self._job_done(loop))
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), self.timeout
+            )
+        except BrokenProcessPool:
+            self._drop_broken(executor)
+            raise
+
+    def _drop_broken(self, executor: ProcessPoolExecutor) -> None:
+        """Shuts down a broken pool, unless it has already been replaced"""
+        if executor is self._executor:
+            log.warning("A chart worker died, starting a new pool")
+            self.close()
+
+    def _job_done(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Called from the pool's thread when a job finishes or is dropped"""
+        def finished() -> None:
+            self._in_flight -= 1
+        try:
+            loop.call_soon_threadsafe(finished)
+        except RuntimeError:
+            # The loop has closed, along with anything waiting on the pool
+            pass
+
+    def close(self) -> None:
+        """Shuts down the worker pool, dropping any queued jobs"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+renderer = ChartRenderer()
+
+# Rendered PNGs keyed by (user_id, data version, minute_intervals, theme).
+# Charts drawn from the database rollup use the negated poo_event_versions
+# counter as their version, so they never clash with a Pooper's version
+chart_cache: LRUCache[tuple[int, int, int, str], bytes] = LRUCache(
+    max_bytes=CHART_CACHE_BYTES,
+    sizeof=len
+)
+
+def forget_user_charts(user_id: int, *_) -> None:
+    """Drops every cached chart of a user, after their events change"""
+    chart_cache.discard_where(lambda key: key[0] == user_id)
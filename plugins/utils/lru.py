@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+class LRUCache(Generic[K, V]):
+    """
+    A dict-like cache that evicts its least recently used entries once it
+    holds more than `max_items` entries or `max_bytes` bytes.
+
+    Parameters
+    ----------
+    max_items: int
+        The most entries to keep (0 for no limit)
+    max_bytes: int
+        The most bytes to keep, as measured by `sizeof` (0 for no limit)
+    sizeof: Callable[[V], int]
+        Measures the size of a value in bytes
+    """
+
+    def __init__(
+                self,
+                max_items: int = 0,
+                max_bytes: int = 0,
+                sizeof: Callable[[V], int] = lambda _: 0
+            ) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._entries: OrderedDict[K, tuple[V, int]] = OrderedDict()
+        self.nbytes: int = 0
+
+    def get(self, key: K) -> V | None:
+        """Gets a value, marking it as recently used"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: K, value: V) -> None:
+        """Stores a value, evicting old entries if the cache is too large"""
+        self.discard(key)
+
+        size = self.sizeof(value)
+        self._entries[key] = (value, size)
+        self.nbytes += size
+
+        while len(self._entries) > 1 and (
+                    (self.max_items and len(self._entries) > self.max_items) or
+                    (self.max_bytes and self.nbytes > self.max_bytes)
+                ):
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.nbytes -= old_size
+
+    def discard(self, key: K) -> None:
+        """Removes a value if it is cached"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def discard_where(self, predicate: Callable[[K], bool]) -> None:
+        """Removes every value whose key matches the predicate"""
+        for key in [key for key in self._entries if predicate(key)]:
+            self.discard(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any
+
+import aiohttp
+
+log = logging.getLogger("plugins.utils.mc_status")
+
+MC_STATUS_API = "https://api.mcstatus.io/v2/status/java/"
+# How long a status is reused before asking the API again (seconds)
+MC_STATUS_TTL: float = 5 * 60
+# How long to wait on the API before falling back to a stale status
+MC_STATUS_TIMEOUT: float = 5.0
+
+class StatusUnavailable(Exception):
+    """Raised when a status can't be fetched and none is cached"""
+
+class MinecraftStatusClient:
+    """
+    Fetches Minecraft server statuses without blocking the event loop.
+
+    Statuses are cached for `ttl` seconds, and concurrent lookups of the
+    same address share a single request. If the API is slow or down, the
+    last known status is returned instead, however old it is.
+
+    Parameters
+    ----------
+    base_url: str
+        The API endpoint the server address is appended to
+    ttl: float
+        How long a status is fresh for, in seconds
+    timeout: float
+        How long to wait on the API, in seconds
+    """
+
+    def __init__(
+                self,
+                base_url: str = MC_STATUS_API,
+                ttl: float = MC_STATUS_TTL,
+                timeout: float = MC_STATUS_TIMEOUT
+            ) -> None:
+        self.base_url = base_url
+        self.ttl = ttl
+        self.timeout = timeout
+
+        self._session: aiohttp.ClientSession | None = None
+        self._statuses: dict[str, tuple[float, dict[str, Any]]] = {}
+        self._in_flight: dict[str, asyncio.Future[dict[str, Any]]] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared HTTP session, created on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def get_status(self, address: str) -> dict[str, Any]:
+        """
+        Gets the status of a server
+
+        Raises
+        ------
+        StatusUnavailable
+            The API could not be reached and there is no cached status
+        """
+        cached = self._statuses.get(address)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        if address not in self._in_flight:
+            self._in_flight[address] = asyncio.ensure_future(
+                self._fetch(address)
+            )
+
+        try:
+            return await asyncio.shield(self._in_flight[address])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if cached:
+                log.warning(f"Serving stale status for {address} ({e!r})")
+                return cached[1]
+            raise StatusUnavailable(f"Couldn't get a status for {address}") from e
+
+    async def _fetch(self, address: str) -> dict[str, Any]:
+        try:
+            async with self.session.get(self.base_url + address) as response:
+                response.raise_for_status()
+                status = await response.json()
+
+            self._statuses[address] = (time.monotonic(), status)
+            return status
+        finally:
+            self._in_flight.pop(address, None)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+mc_status = MinecraftStatusClient()
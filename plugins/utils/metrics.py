@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Any, AsyncIterator, Callable, Iterable
+
+log = logging.getLogger("plugins.utils.metrics")
+
+# The local port the Prometheus text dump is served on (0 to disable). Each
+# process on a host needs its own, so it can be set with POO_METRICS_PORT
+METRICS_PORT: int = int(os.environ.get("POO_METRICS_PORT", 9108))
+
+# Latency buckets in seconds, from 1ms up to 30s
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+def _format_labels(names: tuple[str, ...], values: tuple[Any, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    """A count that only goes up, split by label values"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple[Any, ...], float] = {}
+
+    def inc(self, *label_values: Any, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Observed values counted into cumulative buckets, split by label values"""
+
+    kind = "histogram"
+
+    def __init__(
+                self,
+                name: str,
+                help: str,
+                labels: Iterable[str] = (),
+                buckets: tuple[float, ...] = DEFAULT_BUCKETS
+            ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        # label values: (count per bucket + overflow, sum, count)
+        self.values: dict[tuple[Any, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, *label_values: Any) -> None:
+        counts, total, count = self.values.get(
+            label_values, ([0] * (len(self.buckets) + 1), 0.0, 0)
+        )
+        counts[bisect_left(self.buckets, value)] += 1
+        self.values[label_values] = (counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, *label_values: Any):
+        """Observes how long the block took, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self) -> Iterable[str]:
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(
+                        (*self.buckets, "+Inf"), counts
+                    ):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    self.labels + ("le",), label_values + (bound,)
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+class Gauge:
+    """A set of values read from a callback each time metrics are rendered"""
+
+    kind = "gauge"
+
+    def __init__(
+                self,
+                name: str,
+                help: str,
+                labels: Iterable[str],
+                collect: Callable[[], Iterable[tuple[tuple[Any, ...], float]]]
+            ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for label_values, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+registry: list[Counter | Histogram | Gauge] = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+COMMAND_LATENCY = register(Histogram(
+    "poo_command_seconds",
+    "Time spent handling each slash command",
+    labels=("command",)
+))
+COMPONENT_LATENCY = register(Histogram(
+    "poo_component_seconds",
+    "Time spent handling each component interaction",
+    labels=("handler",)
+))
+POOL_ACQUIRE_WAIT = register(Histogram(
+    "poo_pool_acquire_seconds",
+    "Time spent waiting for a database connection"
+))
+QUERY_DURATION = register(Histogram(
+    "poo_query_seconds",
+    "Time spent running database queries, by statement",
+    labels=("statement",)
+))
+CACHE_LOOKUPS = register(Counter(
+    "poo_cache_lookups_total",
+    "Pooper cache lookups, by whether they hit, missed or created a Pooper",
+    labels=("result",)
+))
+
+def timed(histogram: Histogram, *label_values: Any):
+    """Records how long each call of an async function takes"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(*label_values):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _log_query(record) -> None:
+    statement = record.query.split(None, 1)[0].upper() if record.query else ""
+    QUERY_DURATION.observe(record.elapsed, statement)
+
+@contextlib.asynccontextmanager
+async def acquire(database) -> AsyncIterator[Any]:
+    """
+    Acquires a connection from `database.Database`, recording how long the
+    pool took to hand it over and how long each query on it runs
+    """
+    start = time.perf_counter()
+    async with database.Database.acquire() as conn:
+        POOL_ACQUIRE_WAIT.observe(time.perf_counter() - start)
+
+        add_logger = getattr(conn, "add_query_logger", None)
+        if add_logger:
+            add_logger(_log_query)
+        try:
+            yield conn
+        finally:
+            if add_logger:
+                conn.remove_query_logger(_log_query)
+
+def render() -> str:
+    """Renders every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+async def _handle_scrape(
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter
+        ) -> None:
+    try:
+        # Whatever was asked for, the answer is the metrics
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n" +
+            b"Content-Type: text/plain; version=0.0.4\r\n" +
+            f"Content-Length: {len(body)}\r\n".encode() +
+            b"Connection: close\r\n\r\n" +
+            body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(port: int = METRICS_PORT) -> asyncio.Server | None:
+    """
+    Serves `render` over HTTP on localhost, for Prometheus to scrape. Returns
+    None if the port is 0 or can't be bound, e.g. because another process
+    on the host already has it.
+    """
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_handle_scrape, "127.0.0.1", port)
+    except OSError:
+        log.exception(f"Couldn't serve metrics on 127.0.0.1:{port}")
+        return None
+    log.info(f"Serving metrics on 127.0.0.1:{port}")
+    return server
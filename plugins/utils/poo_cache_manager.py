@@ -1,30 +1,164 @@
+import asyncio
+import io
+import json
 import logging
+import tempfile
 
+import aiohttp
 import novus as n
 from novus import types as t
-from novus.ext import client
+from novus.ext import client, database as db
 
-from .poo_cache_utils import load_data, log_cache
+from .poo_cache_utils import load_data, log_cache, write_queue, \
+                                poo_import_events, stream_user_events, \
+                                save_snapshot, apply_event_change, \
+                                resync_stale_poopers, EVENT_CHANNEL, \
+                                fetch_pooper, \
+                                publish_shared_cache, refresh_shared_cache, \
+                                shared_publisher, shared_reader
+from .poo_snapshot import SNAPSHOT_INTERVAL
+from .poo_shared import SHARED_POLL_INTERVAL, SHARED_PUBLISH_INTERVAL
+from .poo_partitions import PARTITION_INTERVAL, ensure_partitions
+from . import metrics, poo_cache_utils
+from .metrics import timed, COMMAND_LATENCY
+from .poo_io import InvalidImport, parse_events, write_events
+
+# The largest file /log import will download
+MAX_IMPORT_BYTES: int = 8 * 1024 * 1024
+# Exports larger than this are spooled to disk instead of kept in memory
+EXPORT_SPOOL_BYTES: int = 1024 * 1024
+# How long to wait before reconnecting the change listener (seconds)
+LISTENER_RETRY_DELAY: float = 5.0
 
 log = logging.getLogger("plugins.cache_handler.poo_cache_manager")
 
 class PooCacheManager(client.Plugin):
 
+    snapshot_task: asyncio.Task | None = None
+    listener_task: asyncio.Task | None = None
+    partition_task: asyncio.Task | None = None
+    shared_task: asyncio.Task | None = None
+    metrics_server: asyncio.Server | None = None
+
+    async def on_unload(self) -> None:
+        """Writes queued events and snapshots the cache before unloading."""
+        for task in (
+                    self.snapshot_task, self.listener_task,
+                    self.partition_task, self.shared_task
+                ):
+            if task:
+                task.cancel()
+        if poo_cache_utils.SHARED_ROLE == "owner":
+            shared_publisher.close()
+        elif poo_cache_utils.SHARED_ROLE == "shard":
+            shared_reader.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        await write_queue.close()
+        await save_snapshot()
+
     @client.event.ready
     async def on_ready(self) -> None:
-        """Loads all the data from the database into the cache."""
-        await load_data()
+        """Loads all the data from the snapshot and database into the cache."""
+        if poo_cache_utils.WRITE_BEHIND:
+            write_queue.start()
+        if self.snapshot_task is None:
+            self.snapshot_task = asyncio.create_task(self.snapshot_loop())
+        if self.partition_task is None:
+            self.partition_task = asyncio.create_task(self.partition_loop())
+        # Listen first so nothing written during the load is missed
+        if self.listener_task is None:
+            self.listener_task = asyncio.create_task(self.listen_for_changes())
+        await load_data(from_snapshot=True)
+        if self.metrics_server is None:
+            self.metrics_server = await metrics.serve()
+        if poo_cache_utils.SHARED_ROLE and self.shared_task is None:
+            self.shared_task = asyncio.create_task(self.shared_loop())
+
+    async def listen_for_changes(self) -> None:
+        """
+        Applies changes that other processes make to poo_events to the cache.
+
+        Notifications are lost while the listener is disconnected, so after
+        reconnecting every cached user whose change counter moved is resynced.
+        """
+        reconnecting = False
+        while True:
+            try:
+                async with metrics.acquire(db) as conn:
+                    closed = asyncio.Event()
+                    conn.add_termination_listener(lambda _: closed.set())
+                    await conn.add_listener(EVENT_CHANNEL, self.on_event_change)
+                    if reconnecting:
+                        await resync_stale_poopers(conn)
+                    log.info(f"Listening for changes on {EVENT_CHANNEL}")
+                    await closed.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Change listener failed")
+
+            reconnecting = True
+            await asyncio.sleep(LISTENER_RETRY_DELAY)
+
+    def on_event_change(self, conn, pid: int, channel: str, payload: str) -> None:
+        """Pinged by asyncpg with each change notification."""
+        try:
+            apply_event_change(json.loads(payload))
+        except Exception:
+            log.exception(f"Couldn't apply change {payload}")
+
+    async def snapshot_loop(self) -> None:
+        """Saves the cache every `SNAPSHOT_INTERVAL` seconds."""
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await save_snapshot()
+            except Exception:
+                log.exception("Failed to save cache snapshot")
+
+    async def partition_loop(self) -> None:
+        """Creates upcoming poo_events partitions every `PARTITION_INTERVAL` seconds."""
+        while True:
+            try:
+                async with metrics.acquire(db) as conn:
+                    await ensure_partitions(conn)
+            except Exception:
+                log.exception("Failed to create poo_events partitions")
+            await asyncio.sleep(PARTITION_INTERVAL)
+
+    async def shared_loop(self) -> None:
+        """
+        Publishes the cache every `SHARED_PUBLISH_INTERVAL` seconds on the
+        owner, or maps the latest publication every `SHARED_POLL_INTERVAL`
+        seconds on shards.
+        """
+        while True:
+            is_owner = poo_cache_utils.SHARED_ROLE == "owner"
+            try:
+                if is_owner:
+                    await publish_shared_cache()
+                else:
+                    await refresh_shared_cache()
+            except Exception:
+                log.exception("Failed to share the cache")
+            await asyncio.sleep(
+                SHARED_PUBLISH_INTERVAL if is_owner else SHARED_POLL_INTERVAL
+            )
 
     @client.command(
         name="load",
         guild_ids=[649715200890765342],
         default_member_permissions=n.Permissions(manage_guild=True)
     )
+    @timed(COMMAND_LATENCY, "load")
     async def load_data(
                 self,
                 ctx: t.CommandI,
             ) -> None:
         """Loads all the data from the database into the cache."""
+        # The current cache keeps serving until the new one is swapped in
+        await ctx.defer()
         await load_data()
         await ctx.send("Reloaded cache.", ephemeral=True)
 
@@ -33,6 +167,7 @@ class PooCacheManager(client.Plugin):
         guild_ids=[649715200890765342],
         default_member_permissions=n.Permissions(manage_guild=True)
     )
+    @timed(COMMAND_LATENCY, "log_cache")
     async def log_cache(
                 self,
                 ctx: t.CommandI,
@@ -40,3 +175,106 @@ class PooCacheManager(client.Plugin):
         """Sends a log message of the cache"""
         log_cache()
         await ctx.send("Logged to terminal.", ephemeral=True)
+
+    @client.command(
+        name="metrics",
+        guild_ids=[649715200890765342],
+        default_member_permissions=n.Permissions(manage_guild=True)
+    )
+    async def send_metrics(
+                self,
+                ctx: t.CommandI,
+            ) -> None:
+        """Sends the latency, cache and database metrics"""
+        dump = metrics.render().encode()
+        await ctx.send(
+            files=[n.File(io.BytesIO(dump), "metrics.txt")],
+            ephemeral=True
+        )
+
+    @client.command(
+        name="log import",
+        options = [
+            n.ApplicationCommandOption(
+                name="file",
+                type=n.ApplicationOptionType.attachment,
+                description="A .csv or .jsonl file of events, each with an event_time",
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "log import")
+    async def import_events(
+                self,
+                ctx: t.CommandI,
+                file: n.Attachment,
+            ) -> None:
+        """Imports a backlog of events from a file"""
+        if file.size > MAX_IMPORT_BYTES:
+            return await ctx.send(
+                "That file is too big to import.", ephemeral=True
+            )
+
+        await ctx.defer()
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(file.url) as response:
+                if response.status != 200:
+                    log.warning(
+                        f"Import download for {ctx.user.id} failed " +
+                        f"({response.status})"
+                    )
+                    return await ctx.send(
+                        "Couldn't download that file, try again later."
+                    )
+                data = await response.read()
+
+        pooper = await fetch_pooper(ctx.user.id)
+        try:
+            records = parse_events(
+                ctx.user.id, data, file.filename, pooper.timezone
+            )
+        except InvalidImport as e:
+            return await ctx.send(f"Couldn't import that file. {e}")
+
+        async with metrics.acquire(db) as conn:
+            inserted = await poo_import_events(ctx.user.id, records, conn)
+
+        await ctx.send(
+            f"Imported {inserted} new events " +
+            f"({len(records) - inserted} were already logged)."
+        )
+
+    @client.command(
+        name="log export",
+        options = [
+            n.ApplicationCommandOption(
+                name="file_type",
+                type=n.ApplicationOptionType.string,
+                description="The format of the file (default **CSV**)",
+                choices=[
+                    n.ApplicationCommandChoice(name="CSV", value="csv"),
+                    n.ApplicationCommandChoice(name="JSONL", value="jsonl"),
+                ],
+                required=False
+            ),
+        ]
+    )
+    @timed(COMMAND_LATENCY, "log export")
+    async def export_events(
+                self,
+                ctx: t.CommandI,
+                file_type: str = "csv",
+            ) -> None:
+        """Exports all of your events to a file"""
+        await ctx.defer()
+
+        with tempfile.SpooledTemporaryFile(EXPORT_SPOOL_BYTES) as export:
+            text = io.TextIOWrapper(export, encoding="utf-8", newline="")
+            async with metrics.acquire(db) as conn:
+                await write_events(
+                    stream_user_events(ctx.user.id, conn), text, file_type
+                )
+            text.flush()
+            export.seek(0)
+
+            await ctx.send(files=[n.File(export, f"poo_events.{file_type}")])
@@ -1,69 +1,824 @@
 from __future__ import annotations
 
+import asyncio
+from collections import OrderedDict
 import logging
-from typing import TYPE_CHECKING
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable
 from datetime import datetime as dt
+from zoneinfo import ZoneInfo as tz, ZoneInfoNotFoundError
 
 if TYPE_CHECKING:
+    from asyncpg import Record
     from asyncpg.connection import Connection
 
 from novus.ext import database as db
 
 from .poo_objects import Volume, Texture, Shape, Feel, Color, Smell, \
-                        LoggedEvent, Pooper
+                        LoggedEvent, Pooper, EPOCH, from_epoch_us, \
+                        DEFAULT_TIMEZONE
+from .poo_snapshot import SNAPSHOT_PATH, dump_snapshot, read_snapshot, \
+                            write_snapshot
+from .poo_shared import SHARED_PUBLISH_INTERVAL, SharedCachePublisher, \
+                        SharedCacheReader, dump_shared
+from . import metrics
+from .write_behind import WriteBehindQueue
+from .poo_io import EVENT_COLUMNS
 
 log = logging.getLogger("plugins.cache_handler.poo_cache_utils")
 global poo_cache
-poo_cache: dict[int, Pooper] = {}
+poo_cache: OrderedDict[int, Pooper] = OrderedDict()
+
+# Load users on first access instead of warming up the whole table
+LAZY_LOADING: bool = False
+
+# Lazy mode evicts the least recently used users to stay under these budgets
+# (0 disables a budget)
+CACHE_MAX_EVENTS: int = 0
+CACHE_MAX_BYTES: int = 0
+
+# Running totals against those budgets, with each user's (events, bytes) as
+# last measured, so eviction doesn't walk the whole cache
+_cache_sizes: dict[int, tuple[int, int]] = {}
+_cache_events: int = 0
+_cache_bytes: int = 0
+
+# How many rows the warm-up pulls from the cursor before yielding
+WARMUP_BATCH_SIZE: int = 1_000
+
+# Users whose events are fully cached, and whether every user is
+global ready_users, warmup_complete
+ready_users: set[int] = set()
+warmup_complete: bool = False
+
+# Queue /log add writes and flush them in batches instead of awaiting them
+WRITE_BEHIND: bool = False
+
+INSERT_EVENT_QUERY = """
+    INSERT INTO
+        poo_events
+        (
+            user_id,
+            volume,
+            texture,
+            shape,
+            feel,
+            wipe_count,
+            color,
+            smell,
+            continuous,
+            rise,
+            event_time
+        )
+    VALUES
+        (
+            $1,
+            $2,
+            $3,
+            $4,
+            $5,
+            $6,
+            $7,
+            $8,
+            $9,
+            $10,
+            $11
+        )
+"""
+
+# Rows are retried after failures, so conflicts mean "already written"
+write_queue = WriteBehindQueue(
+    INSERT_EVENT_QUERY + "ON CONFLICT DO NOTHING"
+)
+
+metrics.register(metrics.Gauge(
+    "poo_user_events",
+    "Events cached for each user",
+    labels=("user_id",),
+    collect=lambda: (
+        ((user_id,), len(pooper)) for user_id, pooper in poo_cache.items()
+    )
+))
+
+# How many rows an export pulls from the database at a time
+EXPORT_CHUNK_SIZE: int = 1_000
+
+# The NOTIFY channel the poo_events trigger publishes changes on
+EVENT_CHANNEL = "poo_events_changed"
+
+# The last change counter seen from the trigger for each user
+_known_versions: dict[int, int] = {}
+
+# Called with the User ID and event whenever an event is added to or removed
+# from the cache
+event_listeners: list[Callable[[int, LoggedEvent], None]] = []
+
+# Each user's timezone from poo_users, resolved once. Users without a row
+# use DEFAULT_TIMEZONE
+_timezones: dict[int, tz] = {}
+
+# Bumped every time a load swaps in a new cache
+cache_generation: int = 0
+
+# (user_id, added event, removed event time) for every change made to the
+# cache while a warm-up or reload is reading the database, or None otherwise.
+# An entry with neither means the user needs resyncing
+_reload_journal: list[
+    tuple[int, LoggedEvent | None, dt | None]
+] | None = None
+
+# How this process shares its cache with other shard processes:
+#   ""      keep a private cache
+#   "owner" load the cache and publish it to shared memory
+#   "shard" map the owner's published cache instead of loading one, and
+#           write through the database so changes reach the owner
+SHARED_ROLE: str = ""
+
+shared_publisher = SharedCachePublisher()
+shared_reader = SharedCacheReader()
+
+# The data versions of the cache when it was last published
+_published_versions: tuple[int, int] | None = None
+
+# (time, user_id, added event, removed event time) for every change a shard
+# makes to its cache. They're replayed onto each publication until the
+# owner has had plenty of time to publish them itself
+_shard_journal: list[tuple[float, int, LoggedEvent | None, dt | None]] = []
+SHARD_JOURNAL_TTL: float = 3 * SHARED_PUBLISH_INTERVAL
+
+# Only one load or reload runs at a time
+_reload_lock = asyncio.Lock()
+
+# Users being loaded ahead of the warm-up, so requests can share one query
+_pending_loads: dict[int, asyncio.Future[Pooper]] = {}
 
 def clear_cache():
-    global poo_cache
-    for _, pooper in poo_cache.items():
-        pooper.clear()
+    """
+    Drops every cached Pooper. They aren't emptied, so anything still
+    holding one keeps a consistent view of it.
+    """
+    global poo_cache, warmup_complete, _cache_events, _cache_bytes
     poo_cache.clear()
+    ready_users.clear()
+    _known_versions.clear()
+    _cache_sizes.clear()
+    _cache_events = _cache_bytes = 0
+    warmup_complete = False
+
+def resolve_timezone(name: str) -> tz:
+    """
+    Resolves an IANA timezone name
+
+    Raises
+    ------
+    ValueError
+        If there is no timezone with the given name
+    """
+    try:
+        return tz(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone {name!r}")
+
+def get_timezone(user_id: int) -> tz:
+    """Gets the timezone a user's events are grouped into days by"""
+    return _timezones.get(user_id, DEFAULT_TIMEZONE)
+
+def _store_timezone(user_id: int, name: str) -> None:
+    try:
+        _timezones[user_id] = resolve_timezone(name)
+    except ValueError:
+        log.warning(f"Ignoring unknown timezone {name!r} for {user_id}")
+
+async def set_user_timezone(
+            user_id: int,
+            timezone: tz,
+            conn: Connection
+        ) -> None:
+    """
+    Saves a user's timezone, redoing the local days of their cached events
+
+    Parameters
+    ----------
+    user_id: int
+        The user to update
+    timezone: tz
+        The user's new timezone
+    conn : Connection
+        The DB connection to save it through
+    """
+    await conn.execute(
+        """
+        INSERT INTO
+            poo_users (user_id, timezone)
+        VALUES
+            ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE
+            SET timezone = excluded.timezone
+        """,
+        user_id,
+        timezone.key
+    )
+    _timezones[user_id] = timezone
+
+    if user_id in poo_cache:
+        poo_cache[user_id].set_timezone(timezone)
+    log.info(f"Set the timezone of {user_id} to {timezone.key}")
 
 def log_cache() -> None:
     """Logs a message of the cache"""
     global poo_cache
     log.info(f"Cache Requested: {poo_cache}")
 
-async def load_data() -> None:
-    """Loads all the data from the database into the cache."""
-    global poo_cache
+async def load_data(from_snapshot: bool = False) -> None:
+    """
+    Loads all the data from the database into the cache.
+
+    The first load warms up an empty cache in place. If `from_snapshot` is
+    set and a snapshot exists at `SNAPSHOT_PATH`, the cache starts from the
+    snapshot and only rows newer than its high-water mark are read from the
+    database. Since the rows arrive ordered by user, each user is marked
+    ready as soon as the cursor moves past them. Users who interact before
+    that are loaded on their own by `fetch_pooper`, and their rows are
+    skipped here.
+
+    Once a cache has been loaded, reloading builds the next generation off to
+    the side while the current one keeps serving. Changes made to the cache
+    in the meantime are journaled and replayed onto the new generation, which
+    is then swapped in without yielding to the event loop.
+    """
+    async with _reload_lock:
+        if SHARED_ROLE == "shard":
+            if not await _refresh_shared_cache():
+                log.info("No shared cache published yet.")
+            return
+
+        # Users are loaded as they show up instead
+        if LAZY_LOADING:
+            clear_cache()
+            log.info("Lazy loading enabled, skipping warm-up.")
+            return
+
+        if warmup_complete:
+            await _reload_generation()
+        else:
+            await _warm_up(from_snapshot)
+
+async def _warm_up(from_snapshot: bool) -> None:
+    """
+    Loads the first generation of the cache in place. Changes notified
+    while the database is being read are journaled and replayed, like a
+    reload, since the cursor may not have reached their users yet.
+    """
+    global warmup_complete, cache_generation, _reload_journal
 
-    # We want a fresh cache every time we load
     clear_cache()
 
-    # Get all the data from the database
-    async with db.Database.acquire() as conn:
-        poo_rows = await conn.fetch(
+    # Start from the last snapshot, if there is one
+    since = EPOCH
+    snapshot = None
+    if from_snapshot:
+        snapshot = await asyncio.to_thread(read_snapshot, SNAPSHOT_PATH)
+    snapshot_versions: dict[int, int] = {}
+    if snapshot:
+        high_water, poopers, snapshot_versions = snapshot
+        for pooper in poopers:
+            poo_cache[pooper.user_id] = pooper
+        since = from_epoch_us(high_water)
+        log.info(f"Loaded {len(poopers)} Poopers from snapshot, up to {since}")
+
+    # Stream the data from the database into the cache
+    log.info("Caching Shit.")
+    _reload_journal = []
+    try:
+        async with metrics.acquire(db) as conn:
+            await _load_timezones(conn)
+            _match_timezones(poo_cache)
+            # Read before the cursor, so the versions never run ahead of it
+            versions = await _fetch_versions(conn)
+            await _stream_events(conn, since, poo_cache, ready_users)
+        journal = _reload_journal
+    finally:
+        _reload_journal = None
+
+    resyncs = _replay_journal(poo_cache, journal)
+    _merge_pending_writes(poo_cache)
+    _seed_versions(versions)
+
+    # The snapshot only has rows up to its high-water mark, so anyone whose
+    # events changed since it was taken is reloaded, as is anyone it left out
+    # who may have rows below the mark
+    if snapshot:
+        for user_id in versions.keys() | snapshot_versions.keys():
+            if versions.get(user_id, 0) != snapshot_versions.get(user_id, 0):
+                _get_or_create(poo_cache, user_id)
+                resyncs.add(user_id)
+
+    warmup_complete = True
+    cache_generation += 1
+    log.info(
+        f"Caching Complete! ({len(journal)} changes replayed, " +
+        f"{len(resyncs)} users to resync) {poo_cache}"
+    )
+
+    for user_id in resyncs:
+        asyncio.ensure_future(resync_pooper(user_id))
+
+async def _reload_generation() -> None:
+    """Builds a new generation of the cache and swaps it in"""
+    global _reload_journal, cache_generation
+
+    new_cache: OrderedDict[int, Pooper] = OrderedDict()
+    new_ready: set[int] = set()
+
+    # Start journaling before the cursor's snapshot is taken, so every change
+    # it might miss is replayed
+    _reload_journal = []
+    try:
+        log.info(f"Building cache generation {cache_generation + 1}.")
+        async with metrics.acquire(db) as conn:
+            await _load_timezones(conn)
+            versions = await _fetch_versions(conn)
+            await _stream_events(conn, EPOCH, new_cache, new_ready)
+        journal = _reload_journal
+    finally:
+        _reload_journal = None
+
+    # Nothing below awaits, so no one sees a half-swapped cache
+    resyncs = _replay_journal(new_cache, journal)
+    _merge_pending_writes(new_cache)
+    _match_timezones(new_cache)
+    _seed_versions(versions)
+
+    poo_cache.clear()
+    poo_cache.update(new_cache)
+    ready_users.clear()
+    ready_users.update(new_ready)
+    cache_generation += 1
+    log.info(
+        f"Swapped in cache generation {cache_generation} " +
+        f"({len(journal)} changes replayed): {poo_cache}"
+    )
+
+    # Changes that were missed while reloading may be missing here too
+    for user_id in resyncs:
+        asyncio.ensure_future(resync_pooper(user_id))
+
+def _replay_journal(
+            cache: OrderedDict[int, Pooper],
+            journal: list[tuple[int, LoggedEvent | None, dt | None]]
+        ) -> set[int]:
+    """
+    Replays journaled changes onto a cache. Changes the database reads
+    already included are skipped.
+
+    Returns
+    -------
+    resyncs : set[int]
+        The users that need resyncing
+    """
+    resyncs: set[int] = set()
+    for user_id, added, removed_time in journal:
+        if added is None and removed_time is None:
+            resyncs.add(user_id)
+            continue
+        pooper = _get_or_create(cache, user_id)
+        if removed_time is not None:
+            pooper.remove(removed_time)
+        if added is not None and not pooper.has_event_at(added.event_time):
+            pooper.append(added)
+    return resyncs
+
+async def _fetch_versions(conn: Connection) -> dict[int, int]:
+    """Reads every user's change counter from poo_event_versions"""
+    rows = await conn.fetch("SELECT user_id, version FROM poo_event_versions")
+    return {row['user_id']: row['version'] for row in rows}
+
+def _seed_versions(versions: dict[int, int]) -> None:
+    """
+    Starts gap detection from the versions a load read, keeping any newer
+    ones already seen through notifications
+    """
+    for user_id, version in versions.items():
+        if _known_versions.get(user_id, 0) < version:
+            _known_versions[user_id] = version
+
+async def _load_timezones(conn: Connection) -> None:
+    timezones = await conn.fetch("SELECT user_id, timezone FROM poo_users")
+    _timezones.clear()
+    for row in timezones:
+        _store_timezone(row['user_id'], row['timezone'])
+
+def _match_timezones(cache: OrderedDict[int, Pooper]) -> None:
+    """Moves Poopers whose users have changed timezone since they were built"""
+    for pooper in cache.values():
+        if pooper.timezone.key != get_timezone(pooper.user_id).key:
+            pooper.set_timezone(get_timezone(pooper.user_id))
+
+async def _stream_events(
+            conn: Connection,
+            since: dt,
+            cache: OrderedDict[int, Pooper],
+            ready: set[int]
+        ) -> None:
+    """
+    Streams every event after `since` into a cache through a server-side
+    cursor, in batches of `WARMUP_BATCH_SIZE`, yielding to the event loop
+    between batches. Users are added to `ready` as the cursor moves past
+    them, and users that are already in it are skipped.
+    """
+    async with conn.transaction():
+        cursor = await conn.cursor(
             """
             SELECT
-                *,
-                event_time AT TIME ZONE 'America/Los_Angeles' AS event_time
+                *
             FROM
                 poo_events
-            """
+            WHERE
+                event_time > $1
+            ORDER BY
+                user_id, event_time
+            """,
+            since
         )
 
-    # Add it to the cache
-    log.info("Caching Shit.")
-    for poo_record in poo_rows:
-        logged_event = LoggedEvent.from_record(poo_record)
-        pooper = get_pooper(poo_record['user_id'])
-        pooper.logged_events.append(logged_event)
+        current_user: int | None = None
+        while poo_rows := await cursor.fetch(WARMUP_BATCH_SIZE):
+            for poo_record in poo_rows:
+                user_id = poo_record['user_id']
+                if user_id != current_user:
+                    if current_user is not None:
+                        ready.add(current_user)
+                    current_user = user_id
+
+                # Already loaded ahead of the warm-up
+                if user_id in ready:
+                    continue
+
+                _get_or_create(cache, user_id).append_record(poo_record)
+
+            # Let waiting interactions run between batches
+            await asyncio.sleep(0)
+
+        if current_user is not None:
+            ready.add(current_user)
+
+def _merge_pending_writes(cache: OrderedDict[int, Pooper]) -> None:
+    """Adds queued writes, which aren't in the database yet, to a cache"""
+    for row in write_queue.pending_rows():
+        pooper = _get_or_create(cache, row[0])
+        if not pooper.has_event_at(row[-1]):
+            pooper.append(LoggedEvent(*row[1:]))
+
+def _get_or_create(cache: OrderedDict[int, Pooper], user_id: int) -> Pooper:
+    pooper = cache.get(user_id)
+    if pooper is None:
+        pooper = cache[user_id] = Pooper(user_id, timezone=get_timezone(user_id))
+    return pooper
+
+def _journal_change(
+            user_id: int,
+            added: LoggedEvent | None = None,
+            removed_time: dt | None = None
+        ) -> None:
+    """
+    Records a change to the cache for the reload in progress, if any. With
+    no event added or removed, the user is resynced after the swap.
+    """
+    if _reload_journal is not None:
+        _reload_journal.append((user_id, added, removed_time))
+    if SHARED_ROLE == "shard" and (added or removed_time):
+        _shard_journal.append((time.monotonic(), user_id, added, removed_time))
+
+async def refresh_shared_cache() -> bool:
+    """
+    Swaps in the latest cache published by the owner process, if there's a
+    newer one. This shard's own recent changes are replayed onto it, since
+    they may not have reached the owner yet.
+
+    Returns
+    -------
+    refreshed : bool
+        Whether a new publication was swapped in
+    """
+    async with _reload_lock:
+        return await _refresh_shared_cache()
+
+async def _refresh_shared_cache() -> bool:
+    """
+    `refresh_shared_cache`, for callers already holding `_reload_lock`. The
+    publication is mapped and its Poopers are built in a thread, and only
+    the swap runs on the event loop.
+    """
+    global warmup_complete, cache_generation, _shard_journal
 
-    log.info(f"Caching Complete! {poo_cache}")
+    publication = await asyncio.to_thread(shared_reader.poll)
+    if publication is None:
+        return False
+    poopers, versions = publication
+
+    new_cache: OrderedDict[int, Pooper] = OrderedDict(
+        (pooper.user_id, pooper) for pooper in poopers
+    )
+
+    expired = time.monotonic() - SHARD_JOURNAL_TTL
+    _shard_journal = [entry for entry in _shard_journal if entry[0] > expired]
+    for _, user_id, added, removed_time in _shard_journal:
+        pooper = _get_or_create(new_cache, user_id)
+        if removed_time is not None and pooper.has_event_at(removed_time):
+            pooper.remove(removed_time)
+        if added is not None and not pooper.has_event_at(added.event_time):
+            pooper.append(added)
+    _merge_pending_writes(new_cache)
+    _seed_versions(versions)
+
+    poo_cache.clear()
+    poo_cache.update(new_cache)
+    ready_users.clear()
+    ready_users.update(new_cache)
+    warmup_complete = True
+    cache_generation += 1
+    log.info(
+        f"Swapped in shared cache generation {cache_generation} " +
+        f"({len(_shard_journal)} changes replayed)"
+    )
+    return True
+
+async def publish_shared_cache() -> None:
+    """
+    Publishes the cache to shared memory for shards, if it has changed since
+    it was last published. The columns are copied on the event loop and
+    written to shared memory in a thread.
+    """
+    global _published_versions
+    if SHARED_ROLE != "owner" or not warmup_complete:
+        return
+
+    # Every change takes a new, higher data version
+    versions = (
+        cache_generation,
+        max((pooper.version for pooper in poo_cache.values()), default=0)
+    )
+    if versions == _published_versions:
+        return
+
+    users = dump_shared(poo_cache.values(), _known_versions)
+    await asyncio.to_thread(shared_publisher.write, users)
+    _published_versions = versions
+
+async def save_snapshot() -> None:
+    """
+    Saves the cache to `SNAPSHOT_PATH`. The columns are copied on the event
+    loop and written to disk in a thread. Nothing is saved until the
+    warm-up has completed, or at all in lazy mode or on shards.
+    """
+    if LAZY_LOADING or not warmup_complete or SHARED_ROLE == "shard":
+        return
+
+    high_water, users = dump_snapshot(poo_cache.values(), _known_versions)
+    await asyncio.to_thread(write_snapshot, SNAPSHOT_PATH, high_water, users)
+
+async def _load_pooper(user_id: int) -> Pooper:
+    """Loads a single user's events by their primary key range"""
+    global poo_cache
+    try:
+        async with metrics.acquire(db) as conn:
+            # Read before the rows, so it never runs ahead of them
+            version = await conn.fetchval(
+                "SELECT version FROM poo_event_versions WHERE user_id = $1",
+                user_id
+            )
+            poo_rows = await conn.fetch(
+                """
+                SELECT
+                    *
+                FROM
+                    poo_events
+                WHERE
+                    user_id = $1
+                ORDER BY
+                    event_time
+                """,
+                user_id
+            )
+            timezone = await conn.fetchval(
+                "SELECT timezone FROM poo_users WHERE user_id = $1",
+                user_id
+            )
+        if timezone is not None:
+            _store_timezone(user_id, timezone)
+
+        pooper = Pooper(user_id, timezone=get_timezone(user_id))
+        for poo_record in poo_rows:
+            pooper.append_record(poo_record)
+
+        # Queued writes aren't in the database yet
+        for row in write_queue.pending_rows():
+            if row[0] == user_id and not pooper.has_event_at(row[-1]):
+                pooper.append(LoggedEvent(*row[1:]))
+
+        # The warm-up may have finished this user while we were querying
+        if user_id not in ready_users:
+            log.info(f"Loaded Pooper {user_id} from the database")
+            poo_cache[user_id] = pooper
+            ready_users.add(user_id)
+            if version is not None:
+                _seed_versions({user_id: version})
+
+        pooper = get_pooper(user_id)
+        evict_cold_poopers(user_id)
+        return pooper
+    finally:
+        _pending_loads.pop(user_id, None)
+
+def _start_load(user_id: int) -> asyncio.Future[Pooper]:
+    """Loads a user, or joins the load already running for them"""
+    if user_id not in _pending_loads:
+        _pending_loads[user_id] = asyncio.ensure_future(
+            _load_pooper(user_id)
+        )
+    return _pending_loads[user_id]
+
+async def fetch_pooper(user_id: int) -> Pooper:
+    """
+    Gets the Pooper object for a User ID, making sure it is fully cached
+
+    While the warm-up is running, or always in `LAZY_LOADING` mode, users that
+    are not cached yet are loaded straight away with their own query.
+    Concurrent requests for the same user wait on the same load.
+    """
+    if user_id in _pending_loads:
+        metrics.CACHE_LOOKUPS.inc("miss")
+        return await asyncio.shield(_pending_loads[user_id])
+
+    if user_id in ready_users or (warmup_complete and not LAZY_LOADING):
+        if user_id in poo_cache:
+            metrics.CACHE_LOOKUPS.inc("hit")
+        pooper = get_pooper(user_id)
+        poo_cache.move_to_end(user_id)
+        return pooper
+
+    metrics.CACHE_LOOKUPS.inc("miss")
+    return await asyncio.shield(_start_load(user_id))
+
+def is_cached(user_id: int) -> bool:
+    """Whether a user's events are fully cached, without loading them"""
+    if user_id in _pending_loads or user_id not in poo_cache:
+        return False
+    return user_id in ready_users or (warmup_complete and not LAZY_LOADING)
+
+async def resync_pooper(user_id: int) -> None:
+    """Reloads a cached user from the database, e.g. after missed changes"""
+    if user_id not in poo_cache:
+        return
+
+    log.info(f"Resyncing Pooper {user_id}")
+    ready_users.discard(user_id)
+    _known_versions.pop(user_id, None)
+    await asyncio.shield(_start_load(user_id))
+
+def apply_event_change(change: dict[str, Any]) -> None:
+    """
+    Applies a change notification from the poo_events trigger to the cache
+
+    Each notification carries the user's change counter from
+    poo_event_versions. If a user's counter skips a value, a notification
+    was missed and the user is reloaded with `resync_pooper` instead.
+    Once the warm-up has completed every cached user is kept up to date,
+    and new users are added outside of lazy mode. Before that, changes are
+    journaled for the warm-up to replay, and in lazy mode changes for users
+    that aren't loaded are ignored, since they'll be loaded from the
+    database anyway. Changes already in the cache, such as our own writes,
+    are skipped.
+    """
+    user_id: int = change['user_id']
+    version: int = change['version']
+
+    record = dict(change['event'])
+    record['event_time'] = dt.fromisoformat(record['event_time'])
+    logged_event = LoggedEvent.from_record(record)
+
+    added = logged_event if change['op'] in ("INSERT", "UPDATE") else None
+    removed_time = None
+    if change['op'] in ("UPDATE", "DELETE"):
+        old_time = change.get('old_event_time') or change['event']['event_time']
+        removed_time = dt.fromisoformat(old_time)
+
+    # A reload in progress may have read the database before this change
+    _journal_change(user_id, added, removed_time)
+
+    if user_id in _pending_loads:
+        # Apply it once the load that's running has finished
+        _pending_loads[user_id].add_done_callback(
+            lambda _: apply_event_change(change)
+        )
+        return
+
+    if warmup_complete and not LAZY_LOADING:
+        get_pooper(user_id)
+    elif user_id not in poo_cache or (
+                not warmup_complete and user_id not in ready_users
+            ):
+        # The warm-up replays its journal, so only the version is kept
+        if _reload_journal is not None:
+            _known_versions[user_id] = max(
+                _known_versions.get(user_id, 0), version
+            )
+        return
+
+    last_version = _known_versions.get(user_id)
+    if last_version is not None and version <= last_version:
+        return
+    _known_versions[user_id] = version
+    if last_version is not None and version != last_version + 1:
+        log.warning(
+            f"Missed changes for {user_id} ({last_version} -> {version})"
+        )
+        asyncio.ensure_future(resync_pooper(user_id))
+        _journal_change(user_id)
+        return
+
+    pooper = poo_cache[user_id]
+    if removed_time is not None:
+        pooper.remove(removed_time)
+    if added is not None and not pooper.has_event_at(added.event_time):
+        pooper.append(added)
+    evict_cold_poopers(user_id)
+
+    for listener in event_listeners:
+        listener(user_id, logged_event)
+
+async def resync_stale_poopers(conn: Connection) -> None:
+    """
+    Resyncs every cached user whose change counter in the database doesn't
+    match the last notification we saw, e.g. after the listener reconnects
+    """
+    versions = await conn.fetch(
+        """
+        SELECT
+            user_id,
+            version
+        FROM
+            poo_event_versions
+        WHERE
+            user_id = ANY($1::BIGINT[])
+        """,
+        list(poo_cache) if warmup_complete else list(ready_users)
+    )
+    for row in versions:
+        if _known_versions.get(row['user_id']) != row['version']:
+            await resync_pooper(row['user_id'])
 
 def get_pooper(user_id: int) -> Pooper:
     """Creates an empty Pooper object if one is not found for a User ID"""
     global poo_cache
     if not user_id in poo_cache:
         log.info(f"Creating Pooper {user_id}")
-        poo_cache[user_id] = Pooper(user_id).clear()
+        metrics.CACHE_LOOKUPS.inc("created")
+        poo_cache[user_id] = Pooper(user_id, timezone=get_timezone(user_id))
 
     return poo_cache[user_id]
 
+def _measure_pooper(user_id: int) -> None:
+    """Updates the running cache totals for a user added, changed or removed"""
+    global _cache_events, _cache_bytes
+    old_events, old_bytes = _cache_sizes.pop(user_id, (0, 0))
+    _cache_events -= old_events
+    _cache_bytes -= old_bytes
+
+    pooper = poo_cache.get(user_id)
+    if pooper is not None:
+        _cache_sizes[user_id] = (len(pooper), pooper.nbytes)
+        _cache_events += len(pooper)
+        _cache_bytes += pooper.nbytes
+
+def evict_cold_poopers(user_id: int) -> None:
+    """
+    Evicts the least recently used Poopers until the cache fits in
+    `CACHE_MAX_EVENTS` and `CACHE_MAX_BYTES`. Only applies to lazy mode, where
+    evicted users are simply loaded again on their next request.
+
+    Parameters
+    ----------
+    user_id: int
+        The user who was just loaded or changed, whose size is measured again
+    """
+    global poo_cache
+    if not LAZY_LOADING or not (CACHE_MAX_EVENTS or CACHE_MAX_BYTES):
+        return
+    _measure_pooper(user_id)
+
+    # Always keep the most recent user, however large they are
+    while len(poo_cache) > 1 and (
+                (CACHE_MAX_EVENTS and _cache_events > CACHE_MAX_EVENTS) or
+                (CACHE_MAX_BYTES and _cache_bytes > CACHE_MAX_BYTES)
+            ):
+        cold_id, pooper = poo_cache.popitem(last=False)
+        ready_users.discard(cold_id)
+        # Otherwise the next notification after a reload looks like a gap
+        _known_versions.pop(cold_id, None)
+        _measure_pooper(cold_id)
+        log.info(f"Evicted {pooper}")
+
 def get_all_poopers() -> list[Pooper]:
     global poo_cache
     return list(poo_cache.values())
@@ -81,6 +836,7 @@ async def poo_modify_cache_db(
             rise: bool,
             event_time: dt,
             conn: Connection | None = None,
+            defer: bool = False,
         ) -> bool:
     """
     Performs an operation on the cache and optionally updates the database
@@ -112,6 +868,9 @@ async def poo_modify_cache_db(
     conn : Connection | None
         An optional DB connection. If given, a query will be run to add the
         given data to the database in addition to the cache
+    defer : bool
+        Whether to queue the row on `write_queue` instead, to be written to
+        the database in a later batch
 
     Returns
     -------
@@ -134,17 +893,27 @@ async def poo_modify_cache_db(
 
     log.info(
         f"Adding event {repr(logged_event)} to {user_id} " +
-        f"{'with DB' if conn else ''}"
+        f"{'with DB' if conn else 'deferred' if defer else ''}"
     )
 
-    # Make sure we have a Pooper object in cache
-    pooper = get_pooper(user_id)
+    # Make sure we have a fully loaded Pooper object in cache
+    pooper = await fetch_pooper(user_id)
 
-    DB_QUERY = (
-        """
-        INSERT INTO
-            poo_events
-            (
+    # CACHE_CHECK must be true to perform the caching and storing
+    CACHE_CHECK: bool = True
+
+    # Perfrom the operation
+    if CACHE_CHECK:
+        pooper.append(logged_event)
+        _journal_change(user_id, logged_event)
+        for listener in event_listeners:
+            listener(user_id, logged_event)
+        evict_cold_poopers(user_id)
+
+        # Queue the write, or if a database connection was given, add it to
+        # the db as well
+        if defer:
+            write_queue.put((
                 user_id,
                 volume,
                 texture,
@@ -156,35 +925,10 @@ async def poo_modify_cache_db(
                 continuous,
                 rise,
                 event_time
-            )
-        VALUES
-            (
-                $1,
-                $2,
-                $3,
-                $4,
-                $5,
-                $6,
-                $7,
-                $8,
-                $9,
-                $10,
-                $11
-            )
-        """
-    )
-
-    # CACHE_CHECK must be true to perform the caching and storing
-    CACHE_CHECK: bool = True
-
-    # Perfrom the operation
-    if CACHE_CHECK:
-        pooper.logged_events.append(logged_event)
-
-        # If a database connection was given, add it to the db as well
-        if conn:
+            ))
+        elif conn:
             await conn.execute(
-                DB_QUERY,
+                INSERT_EVENT_QUERY,
                 user_id,
                 volume,
                 texture,
@@ -198,4 +942,101 @@ async def poo_modify_cache_db(
                 event_time
             )
 
-    return CACHE_CHECK
\ No newline at end of file
+    return CACHE_CHECK
+
+async def poo_import_events(
+            user_id: int,
+            records: list[tuple],
+            conn: Connection
+        ) -> int:
+    """
+    Bulk loads events into the database and the cache
+
+    The records are copied into a temporary table with a binary COPY, then
+    moved into poo_events in one statement. Rows that already exist are
+    skipped, and only the rows that were actually inserted are added to the
+    cache.
+
+    Parameters
+    ----------
+    user_id: int
+        The user_id of the Pooper to update
+    records: list[tuple]
+        The events to add, as `user_id, *EVENT_COLUMNS` records
+    conn : Connection
+        The DB connection to load through
+
+    Returns
+    -------
+    inserted : int
+        The number of new events
+    """
+
+    # Make sure we have a fully loaded Pooper object in cache
+    pooper = await fetch_pooper(user_id)
+
+    columns = ", ".join(("user_id",) + EVENT_COLUMNS)
+    async with conn.transaction():
+        await conn.execute(
+            """
+            CREATE TEMPORARY TABLE
+                poo_import
+                (LIKE poo_events INCLUDING DEFAULTS)
+            ON COMMIT DROP
+            """
+        )
+        await conn.copy_records_to_table(
+            "poo_import",
+            records=records,
+            columns=("user_id",) + EVENT_COLUMNS
+        )
+        poo_rows = await conn.fetch(
+            f"""
+            INSERT INTO
+                poo_events
+                ({columns})
+            SELECT
+                {columns}
+            FROM
+                poo_import
+            ON CONFLICT DO NOTHING
+            RETURNING
+                *
+            """
+        )
+
+    log.info(f"Imported {len(poo_rows)}/{len(records)} events to {user_id}")
+
+    # A single rebuild, since imports are usually backdated
+    pooper.extend_records(poo_rows)
+    for poo_record in poo_rows:
+        logged_event = LoggedEvent.from_record(poo_record)
+        _journal_change(user_id, logged_event)
+        for listener in event_listeners:
+            listener(user_id, logged_event)
+    evict_cold_poopers(user_id)
+
+    return len(poo_rows)
+
+async def stream_user_events(
+            user_id: int,
+            conn: Connection,
+            chunk_size: int = EXPORT_CHUNK_SIZE
+        ) -> AsyncIterator[list[Record]]:
+    """Yields a user's events from the database, oldest first, in chunks"""
+    async with conn.transaction():
+        cursor = await conn.cursor(
+            """
+            SELECT
+                *
+            FROM
+                poo_events
+            WHERE
+                user_id = $1
+            ORDER BY
+                event_time
+            """,
+            user_id
+        )
+        while poo_rows := await cursor.fetch(chunk_size):
+            yield poo_rows
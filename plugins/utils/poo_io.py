@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+from typing import Any, AsyncIterator, IO
+
+import datetime as dt
+
+from .poo_objects import Volume, Texture, Shape, Feel, Color, Smell, \
+                        PoopEnum, DEFAULT_TIMEZONE
+
+# The poo_events columns an import or export file carries, in order
+EVENT_COLUMNS = (
+    "volume",
+    "texture",
+    "shape",
+    "feel",
+    "wipe_count",
+    "color",
+    "smell",
+    "continuous",
+    "rise",
+    "event_time",
+)
+
+ENUM_COLUMNS: dict[str, type[PoopEnum]] = {
+    "volume": Volume,
+    "texture": Texture,
+    "shape": Shape,
+    "feel": Feel,
+    "color": Color,
+    "smell": Smell,
+}
+
+# Imported events must fall between this and `FUTURE_LEEWAY` from now, so a
+# mistyped year can't stretch a user's per-day totals over centuries
+EARLIEST_EVENT_TIME = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+FUTURE_LEEWAY = dt.timedelta(days=1)
+
+TRUE_VALUES = {"1", "true", "yes", "y", "t"}
+FALSE_VALUES = {"0", "-1", "false", "no", "n", "f"}
+
+class InvalidImport(ValueError):
+    """Raised when a row of an imported file can't be turned into an event"""
+
+    def __init__(self, line: int, message: str) -> None:
+        self.line = line
+        super().__init__(f"Line {line}: {message}")
+
+def _parse_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"{value!r} is not a yes/no value")
+
+def _parse_time(value: Any, timezone: dt.tzinfo) -> dt.datetime:
+    event_time = dt.datetime.fromisoformat(str(value).strip())
+    if event_time.tzinfo is None:
+        event_time = event_time.replace(tzinfo=timezone)
+    latest = dt.datetime.now(dt.timezone.utc) + FUTURE_LEEWAY
+    if not EARLIEST_EVENT_TIME <= event_time <= latest:
+        raise ValueError(f"event_time {event_time.isoformat()} out of range")
+    return event_time
+
+def parse_row(
+            user_id: int,
+            row: dict[str, Any],
+            line: int,
+            timezone: dt.tzinfo = DEFAULT_TIMEZONE
+        ) -> tuple:
+    """
+    Validates a single imported row and converts it to a poo_events record
+
+    Missing attributes fall back to the same defaults as `/log add`, but
+    every row needs an `event_time` between `EARLIEST_EVENT_TIME` and
+    `FUTURE_LEEWAY` from now. Times without an offset are taken to be in the
+    given timezone.
+
+    Raises
+    ------
+    InvalidImport
+        The row has a missing or invalid value
+    """
+    if not row.get("event_time"):
+        raise InvalidImport(line, "missing event_time")
+
+    record: list[Any] = [user_id]
+    try:
+        for column in EVENT_COLUMNS:
+            value = row.get(column)
+            if column in ENUM_COLUMNS:
+                enum = ENUM_COLUMNS[column]
+                record.append(
+                    enum.DEFAULT if value in (None, "") else enum(int(value))
+                )
+            elif column == "wipe_count":
+                wipe_count = 1 if value in (None, "") else int(value)
+                if not 0 <= wipe_count <= 32_700:
+                    raise ValueError(f"wipe_count {wipe_count} out of range")
+                record.append(wipe_count)
+            elif column in ("continuous", "rise"):
+                record.append(True if value in (None, "") else _parse_bool(value))
+            else:
+                record.append(_parse_time(value, timezone))
+    except (ValueError, TypeError, OverflowError) as e:
+        raise InvalidImport(line, str(e)) from None
+
+    return tuple(record)
+
+def parse_events(
+            user_id: int,
+            data: bytes,
+            filename: str,
+            timezone: dt.tzinfo = DEFAULT_TIMEZONE
+        ) -> list[tuple]:
+    """
+    Parses a CSV or JSONL file of events into poo_events records, in the
+    order `user_id, *EVENT_COLUMNS`. Times without an offset are taken to be
+    in the given timezone.
+
+    Raises
+    ------
+    InvalidImport
+        The file is not CSV/JSONL or a row is invalid
+    """
+    text = data.decode("utf-8-sig")
+
+    if filename.lower().endswith(".csv"):
+        reader = csv.DictReader(io.StringIO(text))
+        return [
+            parse_row(user_id, row, line, timezone)
+            for line, row in enumerate(reader, start=2)
+        ]
+
+    if filename.lower().endswith((".jsonl", ".ndjson")):
+        records = []
+        for line, raw in enumerate(text.splitlines(), start=1):
+            if not raw.strip():
+                continue
+            try:
+                row = json.loads(raw)
+            except json.JSONDecodeError as e:
+                raise InvalidImport(line, f"invalid JSON ({e.msg})") from None
+            if not isinstance(row, dict):
+                raise InvalidImport(line, "expected a JSON object")
+            records.append(parse_row(user_id, row, line, timezone))
+        return records
+
+    raise InvalidImport(0, "only .csv and .jsonl files can be imported")
+
+def _format_value(value: Any) -> Any:
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return value
+    return int(value)
+
+async def write_events(
+            chunks: AsyncIterator[list[Any]],
+            file: IO[str],
+            file_format: str = "csv"
+        ) -> None:
+    """
+    Writes chunks of poo_events records to a text file as they arrive, so
+    an export never holds more than one chunk in memory
+
+    Parameters
+    ----------
+    chunks: AsyncIterator[list[Any]]
+        Lists of records with at least the `EVENT_COLUMNS`
+    file: IO[str]
+        Where to write the events
+    file_format: str
+        Either "csv" or "jsonl"
+    """
+    writer = csv.writer(file) if file_format == "csv" else None
+    if writer:
+        writer.writerow(EVENT_COLUMNS)
+
+    async for chunk in chunks:
+        for record in chunk:
+            values = [_format_value(record[column]) for column in EVENT_COLUMNS]
+            if writer:
+                writer.writerow(values)
+            else:
+                file.write(json.dumps(dict(zip(EVENT_COLUMNS, values))) + "\n")
@@ -1,11 +1,44 @@
 from __future__ import annotations
 from enum import IntEnum
 
-from typing import Any
+from typing import Any, Iterable
 
+from collections import Counter
+import sys
+
+from array import array
+from itertools import count
+from bisect import bisect_left, bisect_right
 import datetime as dt
 from zoneinfo import ZoneInfo as tz
 
+from .prefix_sums import DayPrefixSums, day_totals
+
+DEFAULT_TIMEZONE = tz("America/Los_Angeles")
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+# Shared by every Pooper so a data version is never reused, even on reload
+_data_versions = count(1)
+
+# Bytes held by the objects behind one entry of each aggregate dict: a date key
+# and its version (counts are small cached ints), a (year, month) key, a year
+DAY_ENTRY_BYTES = sys.getsizeof(dt.date.min) + sys.getsizeof(2 ** 40)
+MONTH_ENTRY_BYTES = sys.getsizeof((2000, 1))
+YEAR_ENTRY_BYTES = sys.getsizeof(2000)
+
+def to_epoch_us(event_time: dt.datetime) -> int:
+    """Converts a datetime to microseconds since the epoch"""
+    if event_time.tzinfo is None:
+        event_time = event_time.replace(tzinfo=DEFAULT_TIMEZONE)
+    return (event_time - EPOCH) // dt.timedelta(microseconds=1)
+
+def from_epoch_us(
+            event_time: int,
+            timezone: dt.tzinfo = DEFAULT_TIMEZONE
+        ) -> dt.datetime:
+    """Converts microseconds since the epoch to a local datetime"""
+    return (EPOCH + dt.timedelta(microseconds=event_time)).astimezone(timezone)
+
 class PoopEnum(IntEnum):
 
     DEFAULT: Any
@@ -97,8 +130,143 @@ class Smell(PoopEnum):
 
     DEFAULT = 2
 
+# Packed event layout, from the lowest bit up: a 6-bit code for each of
+# volume, texture, shape, feel, color and smell, a 16-bit wipe count and the
+# continuous and rise flags
+CODE_BITS = 6
+WIPE_SHIFT = 6 * CODE_BITS
+CONTINUOUS_BIT = 1 << (WIPE_SHIFT + 16)
+RISE_BIT = CONTINUOUS_BIT << 1
+
+def _decode_table(enum: type[PoopEnum]) -> tuple[PoopEnum | None, ...]:
+    return tuple(
+        enum._value2member_map_.get(code) for code in range(1 << CODE_BITS)
+    ) # type: ignore
+
+# Member of each enum by code, None where a code isn't valid
+DECODE_TABLES: dict[type[PoopEnum], tuple[PoopEnum | None, ...]] = {
+    enum: _decode_table(enum)
+    for enum in (Volume, Texture, Shape, Feel, Color, Smell)
+}
+_VOLUMES = DECODE_TABLES[Volume]
+_TEXTURES = DECODE_TABLES[Texture]
+_SHAPES = DECODE_TABLES[Shape]
+_FEELS = DECODE_TABLES[Feel]
+_COLORS = DECODE_TABLES[Color]
+_SMELLS = DECODE_TABLES[Smell]
+
+# A bit set for each valid code of each enum, so codes can be checked
+# without any lookups
+def _code_mask(enum: type[PoopEnum]) -> int:
+    return sum(1 << member.value for member in enum) # type: ignore
+
+_VOLUME_CODES = _code_mask(Volume)
+_TEXTURE_CODES = _code_mask(Texture)
+_SHAPE_CODES = _code_mask(Shape)
+_FEEL_CODES = _code_mask(Feel)
+_COLOR_CODES = _code_mask(Color)
+_SMELL_CODES = _code_mask(Smell)
+
+def decode_enum(enum: type[PoopEnum], code: int) -> Any:
+    """
+    Looks up the member of an enum for a code, only falling back to the enum
+    constructor (and `PoopEnum._missing_`) for codes outside the table
+    """
+    table = DECODE_TABLES[enum]
+    if 0 <= code < len(table):
+        member = table[code]
+        if member is not None:
+            return member
+    return enum(code)
+
+def pack_event(
+            volume: int,
+            texture: int,
+            shape: int,
+            feel: int,
+            wipe_count: int,
+            color: int,
+            smell: int,
+            continuous: bool,
+            rise: bool
+        ) -> int:
+    """
+    Packs the attributes of an event into a single 64-bit integer
+
+    Raises
+    ------
+    ValueError
+        One of the codes isn't part of its enum
+    """
+    try:
+        valid = (
+            _VOLUME_CODES >> volume
+            & _TEXTURE_CODES >> texture
+            & _SHAPE_CODES >> shape
+            & _FEEL_CODES >> feel
+            & _COLOR_CODES >> color
+            & _SMELL_CODES >> smell
+            & 1
+        )
+    except ValueError:
+        # Negative codes, like -1 for the default
+        valid = 0
+    if not valid:
+        volume = decode_enum(Volume, volume)
+        texture = decode_enum(Texture, texture)
+        shape = decode_enum(Shape, shape)
+        feel = decode_enum(Feel, feel)
+        color = decode_enum(Color, color)
+        smell = decode_enum(Smell, smell)
+
+    return (
+        volume
+        | texture << CODE_BITS
+        | shape << 2 * CODE_BITS
+        | feel << 3 * CODE_BITS
+        | color << 4 * CODE_BITS
+        | smell << 5 * CODE_BITS
+        | (wipe_count & 0xFFFF) << WIPE_SHIFT
+        | (CONTINUOUS_BIT if continuous else 0)
+        | (RISE_BIT if rise else 0)
+    )
+
+def unpack_wipe_count(packed: int) -> int:
+    """The wipe count of a packed event"""
+    wipe_count = (packed >> WIPE_SHIFT) & 0xFFFF
+    return wipe_count - 0x10000 if wipe_count & 0x8000 else wipe_count
+
+def unpack_event(packed: int, event_time: dt.datetime) -> LoggedEvent:
+    """Builds a `LoggedEvent` from a packed event, for display"""
+    mask = (1 << CODE_BITS) - 1
+    return LoggedEvent(
+        volume = _VOLUMES[packed & mask], # type: ignore
+        texture = _TEXTURES[packed >> CODE_BITS & mask], # type: ignore
+        shape = _SHAPES[packed >> 2 * CODE_BITS & mask], # type: ignore
+        feel = _FEELS[packed >> 3 * CODE_BITS & mask], # type: ignore
+        wipe_count = unpack_wipe_count(packed),
+        color = _COLORS[packed >> 4 * CODE_BITS & mask], # type: ignore
+        smell = _SMELLS[packed >> 5 * CODE_BITS & mask], # type: ignore
+        continuous = bool(packed & CONTINUOUS_BIT),
+        rise = bool(packed & RISE_BIT),
+        event_time = event_time
+    )
+
 class LoggedEvent:
 
+    __slots__ = (
+        "volume",
+        "texture",
+        "shape",
+        "feel",
+        "wipe_count",
+        "color",
+        "smell",
+        "continuous",
+        "rise",
+        "event_time",
+    )
+
     def __init__(
                 self,
                 volume: Volume = Volume.DEFAULT,
@@ -110,7 +278,7 @@ class LoggedEvent:
                 smell: Smell = Smell.DEFAULT,
                 continuous: bool = True,
                 rise: bool = True,
-                event_time: dt.datetime = dt.datetime.now(tz("America/Los_Angeles"))
+                event_time: dt.datetime = dt.datetime.now(DEFAULT_TIMEZONE)
             ) -> None:
 
         """Initializes an event..."""
@@ -152,13 +320,13 @@ class LoggedEvent:
     def from_record(cls, record) -> LoggedEvent:
         try:
             return cls(
-                volume = Volume(record['volume']),
-                texture = Texture(record['texture']),
-                shape = Shape(record['shape']),
-                feel = Feel(record['feel']),
+                volume = decode_enum(Volume, record['volume']),
+                texture = decode_enum(Texture, record['texture']),
+                shape = decode_enum(Shape, record['shape']),
+                feel = decode_enum(Feel, record['feel']),
                 wipe_count = record['wipe_count'],
-                color = Color(record['color']),
-                smell = Smell(record['smell']),
+                color = decode_enum(Color, record['color']),
+                smell = decode_enum(Smell, record['smell']),
                 continuous = record['continuous'],
                 rise = record['rise'],
                 event_time = record['event_time']
@@ -167,54 +335,478 @@ class LoggedEvent:
             raise KeyError("Invalid Event record passed to `from_record`.")
 
 class Pooper:
+    """
+    The cached events of a single user, stored column by column.
+
+    Every event's enum codes, wipe count and flags are packed into a single
+    int64 (see `pack_event`), stored next to an int64 of microseconds since
+    the epoch for the event time. `LoggedEvent` objects are only built, through
+    precomputed lookup tables, when an event is actually shown through
+    `get_event` or `logged_events`.
+
+    Each event's local day (as a date ordinal) and minute of the day, in the
+    user's `timezone`, are worked out once when it is added and stored as
+    columns of their own, so grouping by day and the clock plot never
+    convert event times again.
+
+    Alongside the columns a sorted index of (event time, row) is kept up to
+    date on every append, so a single day's page can be found with two
+    binary searches instead of sorting the whole history.
+
+    `version` changes whenever the events change, so anything derived from
+    them can be cached against it.
+
+    Running totals per local year, (year, month) and date, along with wipe
+    totals, are also kept up to date on append so statistics never need to
+    walk the individual events. `day_versions` holds the `version` at which
+    each local date last changed. `daily_events` and `daily_wipes` hold
+    running totals per local day, so any range of days can be added up with
+    `range_totals` in constant time.
+
+    A Pooper built with `from_shared` reads its columns straight out of
+    shared memory, and only copies them once it's changed.
+    """
 
-    def __init__(self, user_id: int, logged_events: list[LoggedEvent] = []):
+    def __init__(
+                self,
+                user_id: int,
+                logged_events: Iterable[LoggedEvent] = (),
+                timezone: tz = DEFAULT_TIMEZONE
+            ) -> None:
         self.user_id = user_id
-        self.logged_events = logged_events
+        self.timezone = timezone
+        self.clear()
+        for event in logged_events:
+            self.append(event)
+
+    # The name and array typecode of every stored column
+    COLUMNS: tuple[tuple[str, str], ...] = (
+        ("attributes", "q"),
+        ("event_times", "q"),
+        ("local_days", "i"),
+        ("minutes", "h"),
+    )
+    attributes: array[int]
+    event_times: array[int]
+    local_days: array[int]
+    minutes: array[int]
 
     def clear(self) -> Pooper:
-        self.logged_events = []
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.shared = False
+        self.reindex()
         return self
 
-    def get_paginated_events(
-                self,
-                max_per_page: int = 6
-            ) -> dict[dt.datetime, list[list[LoggedEvent]]]:
+    @classmethod
+    def from_columns(
+                cls,
+                user_id: int,
+                columns: dict[str, bytes | memoryview],
+                timezone: tz = DEFAULT_TIMEZONE
+            ) -> Pooper:
+        """
+        Builds a Pooper from the raw bytes of each of its `COLUMNS`, whose
+        local columns must have been worked out in the given timezone
+        """
+        pooper = cls(user_id, timezone=timezone)
+        for name, typecode in cls.COLUMNS:
+            column = array(typecode)
+            column.frombytes(columns[name])
+            setattr(pooper, name, column)
+
+        if len({len(getattr(pooper, name)) for name, _ in cls.COLUMNS}) > 1:
+            raise ValueError("Columns passed to `from_columns` differ in length.")
+
+        pooper.reindex()
+        return pooper
+
+    @classmethod
+    def from_shared(
+                cls,
+                user_id: int,
+                columns: dict[str, memoryview],
+                timezone: tz = DEFAULT_TIMEZONE
+            ) -> Pooper:
         """
-        Retrieves a dict of Master Datetime: Matrix of events with
-        max events per page
+        Builds a read-only Pooper straight on top of shared memory, holding
+        each of its `COLUMNS` with its rows already sorted by event time.
+        Only the aggregates are built, and the columns are only copied if
+        the Pooper is changed.
         """
-        paginated_events: dict[dt.datetime, list[list[LoggedEvent]]] = {}
-        for event in sorted(
-                self.logged_events,
-                key=lambda e: dt.datetime(e.event_time.year,
-                                          e.event_time.month,
-                                          e.event_time.day
-                                        )
-            ):
-            event_time = event.event_time
-            master_time = dt.datetime(
-                year=event_time.year,
-                month=event_time.month,
-                day=event_time.day,
-                tzinfo=tz("America/Los_Angeles")
+        pooper = cls.__new__(cls)
+        pooper.user_id = user_id
+        pooper.timezone = timezone
+        for name, typecode in cls.COLUMNS:
+            setattr(pooper, name, columns[name].cast(typecode))
+        pooper.shared = True
+
+        # The rows are in order, so the columns are their own index
+        pooper._sorted_times = pooper.event_times
+        pooper._sorted_rows = range(len(pooper))
+        pooper._recount()
+        return pooper
+
+    def _make_private(self) -> None:
+        """Copies shared columns into arrays of our own, before a change"""
+        if not self.shared:
+            return
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode, getattr(self, name)))
+        self.shared = False
+        self._sorted_times = array("q", self.event_times)
+        self._sorted_rows = array("l", range(len(self)))
+
+    def reindex(self) -> None:
+        """Rebuilds the day index and aggregates from the columns"""
+        self._sorted_rows = array(
+            "l", sorted(range(len(self)), key=self.event_times.__getitem__)
+        )
+        self._sorted_times = array(
+            "q", (self.event_times[row] for row in self._sorted_rows)
+        )
+        self._recount()
+
+    def _recount(self) -> None:
+        # Counted by ordinal first so only distinct days become dates
+        ordinal_counts = Counter(self.local_days)
+        self.day_counts: Counter[dt.date] = Counter({
+            dt.date.fromordinal(local_day): day_count
+            for local_day, day_count in ordinal_counts.items()
+        })
+        self.year_counts: Counter[int] = Counter()
+        self.month_counts: Counter[tuple[int, int]] = Counter()
+        for local_date, day_count in self.day_counts.items():
+            self.year_counts[local_date.year] += day_count
+            self.month_counts[(local_date.year, local_date.month)] += day_count
+        wipe_counts = [unpack_wipe_count(packed) for packed in self.attributes]
+        self.total_wipes: int = sum(wipe_counts)
+        self.max_wipe: int = max(wipe_counts, default=0)
+
+        self.daily_events = DayPrefixSums.from_totals(ordinal_counts)
+        self.daily_wipes = DayPrefixSums.from_totals(
+            day_totals(self.local_days, wipe_counts)
+        )
+
+        self.version = next(_data_versions)
+        self.day_versions: dict[dt.date, int] = dict.fromkeys(
+            self.day_counts, self.version
+        )
+
+    def _count_event(self, local_day: int, wipe_count: int) -> dt.date:
+        local_date = dt.date.fromordinal(local_day)
+        self.year_counts[local_date.year] += 1
+        self.month_counts[(local_date.year, local_date.month)] += 1
+        self.day_counts[local_date] += 1
+        self.total_wipes += wipe_count
+        self.max_wipe = max(self.max_wipe, wipe_count)
+        return local_date
+
+    def append(self, event: LoggedEvent) -> None:
+        """Adds an event to the end of the columns"""
+        self._append_values(
+            event.volume,
+            event.texture,
+            event.shape,
+            event.feel,
+            event.wipe_count,
+            event.color,
+            event.smell,
+            event.continuous,
+            event.rise,
+            to_epoch_us(event.event_time)
+        )
+
+    def append_record(self, record) -> None:
+        """Adds a database record straight to the columns"""
+        try:
+            self._append_values(
+                record['volume'],
+                record['texture'],
+                record['shape'],
+                record['feel'],
+                record['wipe_count'],
+                record['color'],
+                record['smell'],
+                record['continuous'],
+                record['rise'],
+                to_epoch_us(record['event_time'])
             )
+        except KeyError:
+            raise KeyError("Invalid Event record passed to `append_record`.")
 
-            if master_time not in paginated_events:
-                paginated_events[master_time] = [[]]
+    def extend_records(self, records: Iterable) -> None:
+        """
+        Adds many database records at once, e.g. from an import. The day
+        index and aggregates are rebuilt once at the end, instead of moving
+        them for every event that lands before the last one.
+        """
+        self._make_private()
+        try:
+            for record in records:
+                self._append_columns(
+                    record['volume'],
+                    record['texture'],
+                    record['shape'],
+                    record['feel'],
+                    record['wipe_count'],
+                    record['color'],
+                    record['smell'],
+                    record['continuous'],
+                    record['rise'],
+                    to_epoch_us(record['event_time'])
+                )
+        except KeyError:
+            raise KeyError("Invalid Event record passed to `extend_records`.")
+        finally:
+            self.reindex()
 
-            if len(paginated_events[master_time][-1]) >= max_per_page:
-                paginated_events[master_time].append([])
+    def _append_values(
+                self,
+                volume: int,
+                texture: int,
+                shape: int,
+                feel: int,
+                wipe_count: int,
+                color: int,
+                smell: int,
+                continuous: bool,
+                rise: bool,
+                event_time: int
+            ) -> None:
+        self._make_private()
+        local_day, _ = self._append_columns(
+            volume,
+            texture,
+            shape,
+            feel,
+            wipe_count,
+            color,
+            smell,
+            continuous,
+            rise,
+            event_time
+        )
+
+        # Events usually arrive in order, making this an append
+        position = bisect_right(self._sorted_times, event_time)
+        self._sorted_times.insert(position, event_time)
+        self._sorted_rows.insert(position, len(self.event_times) - 1)
+
+        local_date = self._count_event(local_day, wipe_count)
+        self.daily_events.add(local_day)
+        self.daily_wipes.add(local_day, wipe_count)
+        self.version = next(_data_versions)
+        self.day_versions[local_date] = self.version
+
+    def _append_columns(
+                self,
+                volume: int,
+                texture: int,
+                shape: int,
+                feel: int,
+                wipe_count: int,
+                color: int,
+                smell: int,
+                continuous: bool,
+                rise: bool,
+                event_time: int
+            ) -> tuple[int, int]:
+        """Adds an event to the columns, returning its local day and minute"""
+        self.attributes.append(pack_event(
+            volume,
+            texture,
+            shape,
+            feel,
+            wipe_count,
+            color,
+            smell,
+            continuous,
+            rise
+        ))
+        self.event_times.append(event_time)
+
+        local_time = from_epoch_us(event_time, self.timezone)
+        local_day = local_time.toordinal()
+        minute = local_time.hour * 60 + local_time.minute
+        self.local_days.append(local_day)
+        self.minutes.append(minute)
+        return local_day, minute
+
+    def set_timezone(self, timezone: tz) -> None:
+        """Moves the user to another timezone, redoing the local columns"""
+        self._make_private()
+        self.timezone = timezone
+        self.local_days = array("i")
+        self.minutes = array("h")
+        for event_time in self.event_times:
+            local_time = from_epoch_us(event_time, timezone)
+            self.local_days.append(local_time.toordinal())
+            self.minutes.append(local_time.hour * 60 + local_time.minute)
+        self.reindex()
+
+    def range_totals(self, start: dt.date, end: dt.date) -> tuple[int, int]:
+        """
+        Adds up the events between two local days
+
+        Parameters
+        ----------
+        start: dt.date
+            The first local day to include
+        end: dt.date
+            The last local day to include
+
+        Returns
+        -------
+        event_count : int
+            The number of events in the range
+        wipe_count : int
+            The sum of their wipe counts
+        """
+        start_day, end_day = start.toordinal(), end.toordinal()
+        return (
+            self.daily_events.total(start_day, end_day),
+            self.daily_wipes.total(start_day, end_day)
+        )
+
+    def has_event_at(self, event_time: dt.datetime) -> bool:
+        """Whether an event is cached at exactly the given time"""
+        event_time_us = to_epoch_us(event_time)
+        position = bisect_left(self._sorted_times, event_time_us)
+        return (
+            position < len(self._sorted_times)
+            and self._sorted_times[position] == event_time_us
+        )
+
+    def remove(self, event_time: dt.datetime) -> bool:
+        """
+        Removes the event at exactly the given time, rebuilding the day index
+        and aggregates
 
-            paginated_events[master_time][-1].append(event)
+        Returns
+        -------
+        removed : bool
+            Whether there was an event to remove
+        """
+        event_time_us = to_epoch_us(event_time)
+        position = bisect_left(self._sorted_times, event_time_us)
+        if (
+                    position >= len(self._sorted_times)
+                    or self._sorted_times[position] != event_time_us
+                ):
+            return False
+
+        self._make_private()
+        row = self._sorted_rows[position]
+        for name, _ in self.COLUMNS:
+            del getattr(self, name)[row]
+        self.reindex()
+        return True
+
+    def get_event(self, index: int) -> LoggedEvent:
+        """Builds a `LoggedEvent` view of the event at the given index"""
+        return unpack_event(
+            self.attributes[index],
+            from_epoch_us(self.event_times[index], self.timezone)
+        )
+
+    @property
+    def logged_events(self) -> list[LoggedEvent]:
+        """Builds views of every cached event, in insertion order"""
+        return [self.get_event(i) for i in range(len(self))]
+
+    def minutes_of_day(self) -> array[int]:
+        """The local minute of the day (0-1439) of each event"""
+        if self.shared:
+            # Shared memory can't be sent to the chart workers
+            return array("h", self.minutes)
+        return self.minutes
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The number of bytes used by the event columns, day index, per-day,
+        per-month and per-year counts and totals, not counting shared columns
+        """
+        totals = (
+            self.daily_events.nbytes + self.daily_wipes.nbytes
+            + sys.getsizeof(self.day_counts) + sys.getsizeof(self.day_versions)
+            + sys.getsizeof(self.month_counts) + sys.getsizeof(self.year_counts)
+            + DAY_ENTRY_BYTES * len(self.day_counts)
+            + MONTH_ENTRY_BYTES * len(self.month_counts)
+            + YEAR_ENTRY_BYTES * len(self.year_counts)
+        )
+        if self.shared:
+            return totals
+        return totals + sum(
+            column.itemsize * len(column)
+            for column in (
+                *(getattr(self, name) for name, _ in self.COLUMNS),
+                self._sorted_times, self._sorted_rows
+            )
+        )
+
+    def _day_bounds(self, day: dt.date) -> tuple[int, int]:
+        """The slice of the sorted index that falls on a local day"""
+        start = dt.datetime(day.year, day.month, day.day, tzinfo=self.timezone)
+        end = start + dt.timedelta(days=1)
+        return (
+            bisect_left(self._sorted_times, to_epoch_us(start)),
+            bisect_left(self._sorted_times, to_epoch_us(end))
+        )
+
+    def get_day_events(
+                self,
+                day: dt.date,
+                after: int | None = None,
+                before: int | None = None,
+                limit: int = 6
+            ) -> tuple[list[LoggedEvent], int]:
+        """
+        Retrieves the events on a local day next to a known event time, so
+        pages can be walked through without counting pages from the start
+
+        Parameters
+        ----------
+        day: dt.date
+            The local day to show
+        after: int | None
+            Only take events after this epoch time (microseconds)
+        before: int | None
+            Only take the last events before this epoch time (microseconds),
+            used instead of `after` if given
+        limit: int
+            The most events to return
+
+        Returns
+        -------
+        events : list[LoggedEvent]
+            Up to `limit` events, in chronological order
+        day_count : int
+            The number of events on the whole day
+        """
+        start, end = self._day_bounds(day)
+        if before is not None:
+            page_end = bisect_left(self._sorted_times, before, start, end)
+            page_start = max(start, page_end - limit)
+        else:
+            page_start = start if after is None else bisect_right(
+                self._sorted_times, after, start, end
+            )
+            page_end = min(end, page_start + limit)
+        return [
+            self.get_event(self._sorted_rows[i])
+            for i in range(page_start, page_end)
+        ], end - start
 
-        return paginated_events
+    def __len__(self) -> int:
+        return len(self.event_times)
 
     def __str__(self) -> str:
         return (f"Pooper(" +
                 f"user_id={self.user_id}, "
-                f"{len(self.logged_events)} events)"
+                f"{len(self)} events)"
             )
 
     def __repr__(self) -> str:
-        return str(self)
\ No newline at end of file
+        return str(self)
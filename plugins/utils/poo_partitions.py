@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from asyncpg.connection import Connection
+
+log = logging.getLogger("plugins.utils.poo_partitions")
+
+# How many months of poo_events partitions to keep created ahead of time
+PARTITION_MONTHS_AHEAD: int = 3
+# How often to check for missing partitions while running (seconds)
+PARTITION_INTERVAL: float = 24 * 60 * 60
+
+async def ensure_partitions(conn: Connection) -> int:
+    """
+    Creates any missing monthly partitions of poo_events up to
+    `PARTITION_MONTHS_AHEAD` months from now, and moves rows out of the
+    default partition into partitions of their own, e.g. after an import of
+    old events. Does nothing if poo_events hasn't been partitioned.
+
+    Returns
+    -------
+    created : int
+        The number of partitions created
+    """
+    created = await conn.fetchval(
+        "SELECT create_poo_event_partitions(now(), $1)",
+        PARTITION_MONTHS_AHEAD
+    )
+    if created:
+        log.info(f"Created {created} poo_events partitions")
+    return created
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import datetime as dt
+from array import array
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo as tz
+
+if TYPE_CHECKING:
+    from asyncpg.connection import Connection
+
+from .poo_objects import LoggedEvent, Pooper, from_epoch_us
+
+class PooStats:
+    """
+    The totals shown by `/stats table`, taken either from a cached Pooper or
+    from the poo_daily_rollup table
+
+    Parameters
+    ----------
+    lifetime: int
+        The number of events ever logged
+    year: int
+        The number of events logged in the current local year
+    month: int
+        The number of events logged in the current local month
+    day: int
+        The number of events logged on the current local day
+    days: int
+        The number of distinct local days with events
+    months: int
+        The number of distinct local months with events
+    years: int
+        The number of distinct local years with events
+    total_wipes: int
+        The sum of every event's wipe count
+    max_wipe: int
+        The highest wipe count of a single event
+    """
+
+    def __init__(
+                self,
+                lifetime: int,
+                year: int,
+                month: int,
+                day: int,
+                days: int,
+                months: int,
+                years: int,
+                total_wipes: int,
+                max_wipe: int
+            ) -> None:
+        self.lifetime = lifetime
+        self.year = year
+        self.month = month
+        self.day = day
+        self.days = days
+        self.months = months
+        self.years = years
+        self.total_wipes = total_wipes
+        self.max_wipe = max_wipe
+
+    @classmethod
+    def from_pooper(cls, pooper: Pooper, today: dt.date) -> PooStats:
+        """Reads the totals from a Pooper's running aggregates"""
+        return cls(
+            lifetime = len(pooper),
+            year = pooper.year_counts[today.year],
+            month = pooper.month_counts[(today.year, today.month)],
+            day = pooper.day_counts[today],
+            days = len(pooper.day_counts),
+            months = len(pooper.month_counts),
+            years = len(pooper.year_counts),
+            total_wipes = pooper.total_wipes,
+            max_wipe = pooper.max_wipe
+        )
+
+async def fetch_rollup_stats(user_id: int, conn: Connection) -> PooStats:
+    """Adds up a user's rows of poo_daily_rollup, one row per local day"""
+    record = await conn.fetchrow(
+        """
+        WITH today AS (
+            SELECT
+                (now() AT TIME ZONE poo_user_timezone($1))::DATE AS local_date
+        )
+        SELECT
+            COALESCE(SUM(rollup.event_count), 0) AS lifetime,
+            COALESCE(SUM(rollup.event_count) FILTER (
+                WHERE date_trunc('year', rollup.local_date)
+                    = date_trunc('year', today.local_date)
+            ), 0) AS year,
+            COALESCE(SUM(rollup.event_count) FILTER (
+                WHERE date_trunc('month', rollup.local_date)
+                    = date_trunc('month', today.local_date)
+            ), 0) AS month,
+            COALESCE(SUM(rollup.event_count) FILTER (
+                WHERE rollup.local_date = today.local_date
+            ), 0) AS day,
+            COUNT(*) AS days,
+            COUNT(DISTINCT date_trunc('month', rollup.local_date)) AS months,
+            COUNT(DISTINCT date_trunc('year', rollup.local_date)) AS years,
+            COALESCE(SUM(rollup.wipe_sum), 0) AS total_wipes,
+            COALESCE(MAX(rollup.wipe_max), 0) AS max_wipe
+        FROM
+            poo_daily_rollup AS rollup,
+            today
+        WHERE
+            rollup.user_id = $1
+            AND rollup.event_count > 0
+        """,
+        user_id
+    )
+    return PooStats(**{key: int(value) for key, value in record.items()})
+
+async def fetch_minute_counts(
+            user_id: int,
+            conn: Connection
+        ) -> tuple[int, array[int], array[int]]:
+    """
+    Reads a user's poo_minute_rollup rows, for drawing a clock plot with
+    one weighted entry per minute instead of one entry per event
+
+    Returns
+    -------
+    version : int
+        The user's change counter from poo_event_versions, 0 if they have
+        never logged an event
+    minutes : array[int]
+        Each local minute of the day (0-1439) with events
+    counts : array[int]
+        The number of events at each of those minutes
+    """
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        version = await conn.fetchval(
+            "SELECT version FROM poo_event_versions WHERE user_id = $1",
+            user_id
+        )
+        rows = await conn.fetch(
+            """
+            SELECT
+                minute,
+                event_count
+            FROM
+                poo_minute_rollup
+            WHERE
+                user_id = $1
+                AND event_count > 0
+            """,
+            user_id
+        )
+
+    return (
+        version or 0,
+        array("h", (row['minute'] for row in rows)),
+        array("l", (row['event_count'] for row in rows))
+    )
+
+async def fetch_rollup_range(
+            user_id: int,
+            start: dt.date,
+            end: dt.date,
+            conn: Connection
+        ) -> tuple[int, int]:
+    """
+    Adds up a user's poo_daily_rollup rows between two local days, both
+    inclusive
+
+    Returns
+    -------
+    event_count : int
+        The number of events in the range
+    wipe_count : int
+        The sum of their wipe counts
+    """
+    record = await conn.fetchrow(
+        """
+        SELECT
+            COALESCE(SUM(event_count), 0) AS event_count,
+            COALESCE(SUM(wipe_sum), 0) AS wipe_count
+        FROM
+            poo_daily_rollup
+        WHERE
+            user_id = $1
+            AND local_date BETWEEN $2 AND $3
+        """,
+        user_id,
+        start,
+        end
+    )
+    return int(record['event_count']), int(record['wipe_count'])
+
+async def fetch_local_today(user_id: int, conn: Connection) -> dt.date:
+    """The current date in a user's timezone, according to the database"""
+    return await conn.fetchval(
+        "SELECT (now() AT TIME ZONE poo_user_timezone($1))::DATE",
+        user_id
+    )
+
+async def fetch_day_events(
+            user_id: int,
+            day: dt.date,
+            conn: Connection,
+            after: int | None = None,
+            before: int | None = None,
+            limit: int = 6
+        ) -> tuple[list[LoggedEvent], int]:
+    """
+    Reads the events on a local day next to a known event time, straight
+    from poo_events. Each call is a range scan of the (user_id, event_time)
+    primary key that stops after `limit` rows, however long the user's
+    history is. Mirrors `Pooper.get_day_events`.
+
+    Parameters
+    ----------
+    user_id: int
+        The user to read
+    day: dt.date
+        The local day to show
+    conn: Connection
+        The database connection to read with
+    after: int | None
+        Only take events after this epoch time (microseconds)
+    before: int | None
+        Only take the last events before this epoch time (microseconds),
+        used instead of `after` if given
+    limit: int
+        The most events to return
+
+    Returns
+    -------
+    events : list[LoggedEvent]
+        Up to `limit` events, in chronological order and local time
+    day_count : int
+        The number of events on the whole day, from poo_daily_rollup
+    """
+    async with conn.transaction(isolation="repeatable_read", readonly=True):
+        record = await conn.fetchrow(
+            """
+            SELECT
+                poo_user_timezone($1) AS timezone,
+                COALESCE((
+                    SELECT
+                        event_count
+                    FROM
+                        poo_daily_rollup
+                    WHERE
+                        user_id = $1
+                        AND local_date = $2
+                ), 0) AS day_count
+            """,
+            user_id,
+            day
+        )
+        timezone = tz(record['timezone'])
+
+        start = dt.datetime(day.year, day.month, day.day, tzinfo=timezone)
+        end = start + dt.timedelta(days=1)
+        if before is not None:
+            end = min(end, from_epoch_us(before))
+        elif after is not None:
+            # Event times are stored to the microsecond
+            start = max(start, from_epoch_us(after + 1))
+
+        rows = await conn.fetch(
+            f"""
+            SELECT
+                *
+            FROM
+                poo_events
+            WHERE
+                user_id = $1
+                AND event_time >= $2
+                AND event_time < $3
+            ORDER BY
+                event_time {"DESC" if before is not None else "ASC"}
+            LIMIT $4
+            """,
+            user_id,
+            start,
+            end,
+            limit
+        )
+
+    if before is not None:
+        rows.reverse()
+    events = [LoggedEvent.from_record(row) for row in rows]
+    for event in events:
+        event.event_time = event.event_time.astimezone(timezone)
+    return events, int(record['day_count'])
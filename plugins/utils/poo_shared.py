@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import logging
+import os
+import sys
+from array import array
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import struct
+from typing import Iterable
+from zoneinfo import ZoneInfo as tz
+
+from .poo_objects import Pooper
+from .poo_snapshot import HEADER, INDEX_ENTRY
+
+log = logging.getLogger("plugins.utils.poo_shared")
+
+# The shared memory segment that points shards at the latest publication
+SHARED_MEMORY_NAME: str = "poo_cache"
+# How often the owner publishes the cache, if it has changed (seconds)
+SHARED_PUBLISH_INTERVAL: float = 60.0
+# How often shards check for a newer publication (seconds)
+SHARED_POLL_INTERVAL: float = 5.0
+
+# Publications use the snapshot layout (see poo_snapshot), except that each
+# user's rows are sorted by event time and their columns start on an 8-byte
+# boundary, so they can be used in place
+SHARED_MAGIC = b"POOSHRD\0"
+SHARED_VERSION = 2
+ALIGNMENT = 8
+
+# The pointer segment: generation, publication segment name, generation
+# again. Readers retry until both generations match, so they never follow a
+# half-written pointer
+POINTER = struct.Struct("<Q64sQ")
+# How many times a reader retries a half-written pointer before giving up
+# until its next poll, in case the owner died part way through writing it
+POINTER_READ_ATTEMPTS: int = 1_000
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def _attach(name: str) -> SharedMemory:
+    """Maps an existing segment without taking ownership of it"""
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name, track=False) # type: ignore
+    segment = SharedMemory(name)
+    # Otherwise this process's resource tracker unlinks it when we exit
+    resource_tracker.unregister(segment._name, "shared_memory") # type: ignore
+    return segment
+
+def dump_shared(
+            poopers: Iterable[Pooper],
+            versions: dict[int, int]
+        ) -> list[tuple[int, int, str, int, list[bytes]]]:
+    """
+    Copies the columns out of the cache with each user's rows sorted by
+    event time, so they can be published off the event loop while the cache
+    keeps changing
+
+    Returns
+    -------
+    users : list[tuple[int, int, str, int, list[bytes]]]
+        The user ID, event count, timezone, change counter and column bytes
+        of every Pooper, as for `dump_snapshot`
+    """
+    users = []
+    for pooper in poopers:
+        if not len(pooper):
+            continue
+
+        # Events are almost always appended in order
+        if pooper.shared or pooper._sorted_times == pooper.event_times:
+            columns = [
+                getattr(pooper, name).tobytes() for name, _ in Pooper.COLUMNS
+            ]
+        else:
+            columns = [
+                array(
+                    typecode,
+                    (getattr(pooper, name)[row] for row in pooper._sorted_rows)
+                ).tobytes()
+                for name, typecode in Pooper.COLUMNS
+            ]
+        users.append((
+            pooper.user_id,
+            len(pooper),
+            pooper.timezone.key,
+            versions.get(pooper.user_id, 0),
+            columns
+        ))
+    return users
+
+class SharedCachePublisher:
+    """
+    Publishes the cache into shared memory for shard processes to map.
+
+    Every publication is written to a new segment before the pointer segment
+    is moved to it, and the previous segment is unlinked. Shards that still
+    have the previous one mapped keep it until they move on. Generations
+    carry on from the pointer left by a previous owner, so shards never
+    mistake a restarted owner's publications for old ones.
+
+    Parameters
+    ----------
+    name: str
+        The name of the pointer segment
+    """
+
+    def __init__(self, name: str = SHARED_MEMORY_NAME) -> None:
+        self.name = name
+        self.generation: int = 0
+
+        self._pointer: SharedMemory | None = None
+        self._segment: SharedMemory | None = None
+
+    def write(
+                self,
+                users: list[tuple[int, int, str, int, list[bytes]]]
+            ) -> None:
+        """Publishes the output of `dump_shared`"""
+        offset = _align(HEADER.size + INDEX_ENTRY.size * len(users))
+        offsets = []
+        for _, _, _, _, columns in users:
+            offsets.append(offset)
+            for column in columns:
+                offset = _align(offset + len(column))
+
+        pointer = self._open_pointer()
+        self.generation += 1
+        segment_name = f"{self.name}_{os.getpid()}_{self.generation}"
+        segment = SharedMemory(segment_name, create=True, size=offset)
+        try:
+            HEADER.pack_into(
+                segment.buf, 0, SHARED_MAGIC, SHARED_VERSION, 0, len(users)
+            )
+            for index, (user, offset) in enumerate(zip(users, offsets)):
+                user_id, event_count, timezone, version, columns = user
+                INDEX_ENTRY.pack_into(
+                    segment.buf,
+                    HEADER.size + INDEX_ENTRY.size * index,
+                    user_id, event_count, offset, timezone.encode(), version
+                )
+                for column in columns:
+                    segment.buf[offset:offset + len(column)] = column
+                    offset = _align(offset + len(column))
+        except BaseException:
+            segment.close()
+            segment.unlink()
+            raise
+
+        self._point_to(pointer, segment_name)
+
+        previous, self._segment = self._segment, segment
+        if previous is not None:
+            previous.close()
+            previous.unlink()
+        log.info(
+            f"Published {len(users)} users to {segment_name} " +
+            f"({offset} bytes)"
+        )
+
+    def _open_pointer(self) -> SharedMemory:
+        if self._pointer is None:
+            try:
+                self._pointer = SharedMemory(
+                    self.name, create=True, size=POINTER.size
+                )
+            except FileExistsError:
+                # Left behind by an owner that didn't shut down cleanly
+                self._pointer = SharedMemory(self.name)
+                generation, _, check = POINTER.unpack_from(self._pointer.buf)
+                self.generation = max(self.generation, generation, check)
+        return self._pointer
+
+    def _point_to(self, pointer: SharedMemory, segment_name: str) -> None:
+        buffer = pointer.buf
+        struct.pack_into("<Q", buffer, POINTER.size - 8, 0)
+        struct.pack_into("<64s", buffer, 8, segment_name.encode())
+        struct.pack_into("<Q", buffer, 0, self.generation)
+        struct.pack_into("<Q", buffer, POINTER.size - 8, self.generation)
+
+    def close(self) -> None:
+        """Unlinks the published segments"""
+        for segment in (self._segment, self._pointer):
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+        self._segment = self._pointer = None
+
+class SharedCacheReader:
+    """
+    Maps the cache published by a `SharedCachePublisher` in another process,
+    read-only. `poll` does no more than read shared memory and build new
+    Poopers, so it can be run in a thread.
+
+    Parameters
+    ----------
+    name: str
+        The name of the pointer segment
+    """
+
+    def __init__(self, name: str = SHARED_MEMORY_NAME) -> None:
+        self.name = name
+        self.generation: int = 0
+        self.segment_name: str | None = None
+
+        self._segment: SharedMemory | None = None
+        # Segments we've moved on from, closed once nothing uses them
+        self._retired: list[SharedMemory] = []
+
+    def _read_pointer(self) -> tuple[int, str] | None:
+        try:
+            pointer = _attach(self.name)
+        except FileNotFoundError:
+            return None
+
+        try:
+            for _ in range(POINTER_READ_ATTEMPTS):
+                generation, name, check = POINTER.unpack_from(pointer.buf)
+                if generation == check:
+                    return generation, name.rstrip(b"\0").decode()
+        finally:
+            pointer.close()
+        log.warning(f"Pointer segment {self.name} is half-written")
+        return None
+
+    def poll(self) -> tuple[list[Pooper], dict[int, int]] | None:
+        """
+        Maps the latest publication, if it's newer than the one mapped
+
+        Returns
+        -------
+        publication : tuple[list[Pooper], dict[int, int]] | None
+            Read-only Poopers over the publication and the change counter
+            each user was published at, or None if there's nothing newer
+        """
+        self._close_retired()
+
+        pointer = self._read_pointer()
+        if pointer is None:
+            return None
+        generation, segment_name = pointer
+        if generation <= self.generation and segment_name == self.segment_name:
+            return None
+
+        try:
+            segment = _attach(segment_name)
+        except FileNotFoundError:
+            # Already replaced, the next poll will find the newer one
+            return None
+
+        magic, version, _, user_count = HEADER.unpack_from(segment.buf)
+        if magic != SHARED_MAGIC or version != SHARED_VERSION:
+            log.warning(f"Ignoring {segment_name} with an unknown format")
+            segment.close()
+            return None
+
+        view = segment.buf.toreadonly()
+        poopers = []
+        versions: dict[int, int] = {}
+        for index in range(user_count):
+            user_id, event_count, offset, timezone, version = (
+                INDEX_ENTRY.unpack_from(
+                    segment.buf, HEADER.size + INDEX_ENTRY.size * index
+                )
+            )
+            versions[user_id] = version
+            columns = {}
+            for name, typecode in Pooper.COLUMNS:
+                size = event_count * struct.calcsize(typecode)
+                columns[name] = view[offset:offset + size]
+                offset = _align(offset + size)
+            poopers.append(Pooper.from_shared(
+                user_id, columns, tz(timezone.rstrip(b"\0").decode())
+            ))
+
+        if self._segment is not None:
+            self._retired.append(self._segment)
+        self._segment = segment
+        self.generation = generation
+        self.segment_name = segment_name
+        log.info(f"Mapped {len(poopers)} users from {segment_name}")
+        return poopers, versions
+
+    def _close_retired(self) -> None:
+        still_used = []
+        for segment in self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                # Old Poopers are still around
+                still_used.append(segment)
+        self._retired = still_used
+
+    def close(self) -> None:
+        """Unmaps every segment that's no longer in use"""
+        if self._segment is not None:
+            self._retired.append(self._segment)
+            self._segment = None
+        self._close_retired()
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+from typing import Iterable
+from zoneinfo import ZoneInfo as tz
+
+from .poo_objects import Pooper
+
+log = logging.getLogger("plugins.utils.poo_snapshot")
+
+# Where the cache is saved between restarts
+SNAPSHOT_PATH: str = "poo_cache.snapshot"
+# How often the cache is saved while running (seconds)
+SNAPSHOT_INTERVAL: float = 15 * 60
+
+# File layout, all little-endian:
+#   header: magic, format version, high-water mark (epoch us), user count
+#   index:  one (user_id, event count, data offset, timezone, change counter)
+#           entry per user
+#   data:   each user's `Pooper.COLUMNS`, one after the other, as raw arrays
+SNAPSHOT_MAGIC = b"POOSNAP\0"
+SNAPSHOT_VERSION = 4
+HEADER = struct.Struct("<8sIqI")
+INDEX_ENTRY = struct.Struct("<qIQ64sq")
+
+def dump_snapshot(
+            poopers: Iterable[Pooper],
+            versions: dict[int, int]
+        ) -> tuple[int, list[tuple[int, int, str, int, list[bytes]]]]:
+    """
+    Copies the columns out of the cache, so they can be written to disk
+    off the event loop while the cache keeps changing
+
+    Parameters
+    ----------
+    poopers: Iterable[Pooper]
+        The cached Poopers
+    versions: dict[int, int]
+        The last poo_event_versions counter seen for each user, which the
+        cached events are up to date with
+
+    Returns
+    -------
+    high_water : int
+        The latest event time in the cache, in epoch microseconds
+    users : list[tuple[int, int, str, int, list[bytes]]]
+        The user ID, event count, timezone, change counter and column bytes
+        of every Pooper
+    """
+    high_water = 0
+    users = []
+    for pooper in poopers:
+        if not len(pooper):
+            continue
+        high_water = max(high_water, max(pooper.event_times))
+        users.append((
+            pooper.user_id,
+            len(pooper),
+            pooper.timezone.key,
+            versions.get(pooper.user_id, 0),
+            [getattr(pooper, name).tobytes() for name, _ in Pooper.COLUMNS]
+        ))
+    return high_water, users
+
+def write_snapshot(
+            path: str,
+            high_water: int,
+            users: list[tuple[int, int, str, int, list[bytes]]]
+        ) -> None:
+    """Atomically writes the output of `dump_snapshot` to a file"""
+    offset = HEADER.size + INDEX_ENTRY.size * len(users)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, high_water, len(users)
+        ))
+        for user_id, event_count, timezone, version, columns in users:
+            file.write(INDEX_ENTRY.pack(
+                user_id, event_count, offset, timezone.encode(), version
+            ))
+            offset += sum(len(column) for column in columns)
+        for _, _, _, _, columns in users:
+            for column in columns:
+                file.write(column)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+    log.info(f"Wrote snapshot of {len(users)} users to {path}")
+
+def read_snapshot(
+            path: str
+        ) -> tuple[int, list[Pooper], dict[int, int]] | None:
+    """
+    Maps a snapshot file and rebuilds the Poopers in it
+
+    Returns
+    -------
+    snapshot : tuple[int, list[Pooper], dict[int, int]] | None
+        The high-water mark, the cached Poopers and the change counter each
+        was up to date with, or None if there's no usable snapshot at the
+        path
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, high_water, user_count = HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            log.warning(f"Ignoring snapshot {path} with an unknown format")
+            return None
+
+        poopers = []
+        versions = {}
+        with memoryview(data) as view:
+            for index in range(user_count):
+                user_id, event_count, offset, timezone, version = (
+                    INDEX_ENTRY.unpack_from(
+                        data, HEADER.size + INDEX_ENTRY.size * index
+                    )
+                )
+                versions[user_id] = version
+                columns = {}
+                for name, typecode in Pooper.COLUMNS:
+                    size = event_count * struct.calcsize(typecode)
+                    columns[name] = view[offset:offset + size]
+                    offset += size
+
+                try:
+                    poopers.append(Pooper.from_columns(
+                        user_id,
+                        columns,
+                        tz(timezone.rstrip(b"\0").decode())
+                    ))
+                finally:
+                    # The mmap can't close while slices of it are alive
+                    for column in columns.values():
+                        column.release()
+
+    log.info(f"Read snapshot of {len(poopers)} users from {path}")
+    return high_water, poopers, versions
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from array import array
+from typing import Iterable
+
+class DayPrefixSums:
+    """
+    Running totals of a value per day, so that the total over any range of
+    days is a single subtraction.
+
+    Days are date ordinals. Entry `i` holds the total of every day before
+    `first_day + i`, for each day from the first to the last one with a
+    value. Adding to the last day, which is where new events almost always
+    land, only touches the final entry. Adding to an earlier day updates
+    every entry after it.
+
+    Parameters
+    ----------
+    typecode: str
+        The array typecode the totals are stored with
+    """
+
+    def __init__(self, typecode: str = "q") -> None:
+        self.first_day: int | None = None
+        self._sums = array(typecode, [0])
+
+    @classmethod
+    def from_totals(
+                cls,
+                totals: dict[int, int],
+                typecode: str = "q"
+            ) -> DayPrefixSums:
+        """Builds the running totals from a total per day ordinal"""
+        prefix_sums = cls(typecode)
+        if not totals:
+            return prefix_sums
+
+        first_day, last_day = min(totals), max(totals)
+        running = 0
+        sums = [0]
+        for day in range(first_day, last_day + 1):
+            running += totals.get(day, 0)
+            sums.append(running)
+
+        prefix_sums.first_day = first_day
+        prefix_sums._sums = array(typecode, sums)
+        return prefix_sums
+
+    @property
+    def last_day(self) -> int | None:
+        """The last day covered, or None if nothing has been added"""
+        if self.first_day is None:
+            return None
+        return self.first_day + len(self._sums) - 2
+
+    def add(self, day: int, amount: int = 1) -> None:
+        """Adds an amount to a day"""
+        if self.first_day is None:
+            self.first_day = day
+            self._sums.append(amount)
+            return
+
+        if day < self.first_day:
+            # Shift everything along to make room for the earlier days
+            gap = self.first_day - day
+            shifted = array(self._sums.typecode, [0] + [amount] * gap)
+            shifted.extend(total + amount for total in self._sums[1:])
+            self.first_day = day
+            self._sums = shifted
+            return
+
+        last_day = self.last_day
+        assert last_day is not None
+        if day > last_day:
+            # Days in between have nothing, so repeat the running total
+            self._sums.extend([self._sums[-1]] * (day - last_day))
+
+        for index in range(day - self.first_day + 1, len(self._sums)):
+            self._sums[index] += amount
+
+    def total(self, start_day: int, end_day: int) -> int:
+        """The total from `start_day` to `end_day`, both inclusive"""
+        if self.first_day is None or end_day < start_day:
+            return 0
+
+        last_index = len(self._sums) - 1
+        start = min(max(start_day - self.first_day, 0), last_index)
+        end = min(max(end_day - self.first_day + 1, 0), last_index)
+        return self._sums[end] - self._sums[start]
+
+    @property
+    def nbytes(self) -> int:
+        return self._sums.itemsize * len(self._sums)
+
+def day_totals(
+            days: Iterable[int],
+            amounts: Iterable[int]
+        ) -> dict[int, int]:
+    """Adds up amounts by the day ordinal they fall on"""
+    totals: dict[int, int] = {}
+    for day, amount in zip(days, amounts):
+        totals[day] = totals.get(day, 0) + amount
+    return totals
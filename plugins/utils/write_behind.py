@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+
+from novus.ext import database as db
+
+from . import metrics
+
+log = logging.getLogger("plugins.utils.write_behind")
+
+# Flush once this many events are waiting
+WRITE_BATCH_SIZE: int = 100
+# Flush any event that has waited this long (seconds)
+WRITE_MAX_AGE: float = 2.0
+
+class WriteBehindQueue:
+    """
+    Buffers database rows and writes them in batches from a background task.
+
+    Rows are written with `executemany`, so a whole batch costs a single
+    pool acquire. A failed batch is logged, counted in `failed_batches` and
+    put back at the front of the queue to be retried on the next flush, at
+    least `max_age` later, so the query should be idempotent.
+
+    Parameters
+    ----------
+    query: str
+        The query run once per row
+    batch_size: int
+        How many rows to wait for before flushing early
+    max_age: float
+        The longest a row may wait before it is flushed, in seconds
+    """
+
+    def __init__(
+                self,
+                query: str,
+                batch_size: int = WRITE_BATCH_SIZE,
+                max_age: float = WRITE_MAX_AGE
+            ) -> None:
+        self.query = query
+        self.batch_size = batch_size
+        self.max_age = max_age
+
+        self._pending: list[tuple] = []
+        # When each pending row was queued, so the oldest is always known
+        self._queued_at: list[float] = []
+        self._in_flight: list[tuple] = []
+        self._retry_at: float | None = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+        self.failed_batches: int = 0
+        self.last_error: BaseException | None = None
+
+    def put(self, row: tuple) -> None:
+        """Queues a row to be written"""
+        self._pending.append(row)
+        self._queued_at.append(time.monotonic())
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_rows(self) -> list[tuple]:
+        """Every row that has not been confirmed as written yet"""
+        return self._in_flight + self._pending
+
+    def start(self) -> None:
+        """Starts the background flusher"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            # Sleep until the oldest row is due, or a batch fills up
+            timeout = self.max_age
+            if self._queued_at:
+                due = self._queued_at[0] + self.max_age
+                if self._retry_at is not None:
+                    due = max(due, self._retry_at)
+                timeout = max(0, due - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._pending:
+                await self.flush()
+
+    async def flush(self) -> bool:
+        """
+        Writes every queued row
+
+        Returns
+        -------
+        success : bool
+            Whether every batch was written
+        """
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                batch_queued_at = self._queued_at[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+                self._queued_at = self._queued_at[self.batch_size:]
+                self._in_flight = batch
+
+                try:
+                    async with metrics.acquire(db) as conn:
+                        await conn.executemany(self.query, batch)
+                except BaseException as e:
+                    # Put the batch back, even if we're being cancelled
+                    self._pending = batch + self._pending
+                    self._queued_at = batch_queued_at + self._queued_at
+                    if not isinstance(e, Exception):
+                        raise
+
+                    # The rows keep their age, but the database gets a
+                    # moment before they're retried
+                    self._retry_at = time.monotonic() + self.max_age
+                    self.failed_batches += 1
+                    self.last_error = e
+                    log.exception(
+                        f"Failed to write {len(batch)} rows, will retry"
+                    )
+                    return False
+                finally:
+                    self._in_flight = []
+
+                self._retry_at = None
+                log.info(f"Wrote {len(batch)} queued rows")
+
+        return True
+
+    async def close(self) -> None:
+        """Stops the background flusher and writes everything left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if not await self.flush():
+            log.error(
+                f"{len(self._pending)} rows could not be written on shutdown"
+            )